@@ -18,26 +18,193 @@
 
 
 import tensorflow as tf
-from user_ops import flex_convolution as _flex_convolution
-from user_ops import flex_pooling as _flex_pooling
-from user_ops import flex_convolution_transpose as _flex_convolution_transpose
-
+try:
+  from user_ops import flex_convolution as _flex_convolution
+  from user_ops import flex_pooling as _flex_pooling
+  from user_ops import flex_convolution_transpose as _flex_convolution_transpose
+  from user_ops import flex_convolution_int8 as _flex_convolution_int8
+  _HAS_USER_OPS = True
+except (ImportError, tf.errors.NotFoundError):
+  # the compiled ops are not available, use the (forward only) CPU fallback
+  from layers_fallback import flex_convolution as _flex_convolution
+  from layers_fallback import flex_pooling as _flex_pooling
+  from layers_fallback import missing_op as _missing_op
+  _flex_convolution_transpose = _missing_op('flex_convolution_transpose')
+  _flex_convolution_int8 = _missing_op('flex_convolution_int8')
+  _HAS_USER_OPS = False
+
+# plain TensorFlow, available with and without the compiled ops
+from layers_gather import flex_gather as _flex_gather
+from layers_gather import flex_pooling_from_gathered as \
+    _flex_pooling_from_gathered
+from layers_gather import flex_convolution_from_gathered as \
+    _flex_convolution_from_gathered
+from layers_gather import quantize_theta as _quantize_theta
+
+from tensorflow.contrib.compiler import jit
 from tensorflow.python.keras import activations
 from tensorflow.python.keras import initializers
+from tensorflow.python.keras.engine.base_layer import InputSpec
 from tensorflow.python.keras.engine.base_layer import Layer
+from tensorflow.python.util import nest
 from tensorflow.python.util.tf_export import tf_export
 from tensorflow.python.framework import tensor_shape
 from tensorflow.python.framework import ops
+from tensorflow.python.framework import tensor_util
 
 
-all = ['FlexPooling', 'FlexConvolution', 'FlexConvolutionTranspose',
-       'flex_pooling', 'flex_convolution', 'flex_convolution_transpose']
+all = ['FlexNeighborhood', 'FlexPooling', 'FlexConvolution',
+       'FlexConvolutionTranspose', 'flex_neighborhood', 'flex_pooling',
+       'flex_convolution', 'flex_convolution_transpose']
 
 
 def _remove_dim(x, axis=2):
+  # squeezing the output of a matching `expand_dims` just forwards its input,
+  # so stacked 'expanded' layers do not add a squeeze/expand pair per layer
+  if not tf.executing_eagerly() and x.op.type == 'ExpandDims':
+    dim = tensor_util.constant_value(x.op.inputs[1])
+    axes = [axis]
+    if x.shape.ndims is not None:
+      axes.append(axis - x.shape.ndims)
+    if dim is not None and int(dim) in axes:
+      return x.op.inputs[0]
   return tf.squeeze(x, axis=axis)
 
 
+def _require_user_ops(feature):
+  # the CPU fallback has no transposed and no int8 op, fail when building the
+  # layer rather than when calling it
+  if not _HAS_USER_OPS:
+    raise NotImplementedError('%s requires the compiled user_ops, which '
+                              'could not be loaded.' % feature)
+
+
+def _input_spec(num_inputs, data_format):
+  # keras validates the number and rank of the inputs before `call`
+  ndim = 4 if data_format in ('expanded', 'gathered') else 3
+  return [InputSpec(ndim=ndim) for _ in range(num_inputs)]
+
+
+def _maybe_cast(x, dtype):
+  # inputs already in the expected dtype pass through without adding a node
+  if x.dtype != dtype:
+    x = tf.cast(x, dtype)
+  return x
+
+
+def _epilogue(use_bias, activation_fn):
+  # bias and activation after an unfused op, None when there is nothing to do
+  if not use_bias and activation_fn is None:
+    return None
+
+  def epilogue(y, bias):
+    if use_bias:
+      # BiasAdd instead of a broadcasting Add, so grappler can match it. The
+      # CPU kernel supports NCHW for 4D inputs only, hence the extra axis.
+      y = tf.nn.bias_add(tf.expand_dims(y, 2), bias, data_format='NCHW')
+      y = tf.squeeze(y, axis=2)
+    if activation_fn is not None:
+      y = activation_fn(y)
+    return y
+
+  return epilogue
+
+
+def _remove_dims(inputs, axis=2):
+  return [_remove_dim(ops.convert_to_tensor(x), axis) for x in inputs]
+
+
+# keras activations the flex convolution op can apply in its epilogue
+_FUSED_ACTIVATIONS = {activations.linear: 'none',
+                      activations.relu: 'relu',
+                      activations.elu: 'elu',
+                      activations.sigmoid: 'sigmoid'}
+
+
+# keras activations which are thin wrappers around a single tf.nn op
+_NN_ACTIVATIONS = {activations.relu: tf.nn.relu,
+                   activations.elu: tf.nn.elu,
+                   activations.selu: tf.nn.selu,
+                   activations.softplus: tf.nn.softplus,
+                   activations.softsign: tf.nn.softsign,
+                   activations.sigmoid: tf.nn.sigmoid,
+                   activations.tanh: tf.nn.tanh}
+
+
+def _fused_activation(activation):
+  if activation is None:
+    return 'none'
+  return _FUSED_ACTIVATIONS.get(activation, None)
+
+
+def _activation_fn(activation):
+  # resolved once per layer, None when there is nothing to apply
+  if activation is None or activation is activations.linear:
+    return None
+  return _NN_ACTIVATIONS.get(activation, activation)
+
+
+@tf_export('keras.layers.FlexNeighborhood')
+class FlexNeighborhood(Layer):
+  """flex neighborhood layer.
+
+  This layer gathers the values of all neighbors of each point. Pooling and
+  convolution layers created with `from_gathered=True` consume its output,
+  such that several of them can share one gather over the same
+  neighborhoods instead of each gathering the neighbors again.
+
+  The layer is called on `[x, neighborhoods]` with x of the format
+  [B, D, (1), N] and neighborhoods of the format [B, K, (1), N] (tf.int32).
+
+  Arguments:
+      data_format: A string, one of `simple` (default) or `expaned`.
+      name: A string, the name of the layer.
+
+  """
+
+  def __init__(self,
+               data_format='simple',
+               name=None):
+
+    super(FlexNeighborhood, self).__init__(name=name)
+    self.data_format = data_format
+    self.input_spec = _input_spec(2, data_format)
+    self._expects_training_arg = False
+
+  def compute_output_shape(self, input_shape):
+    x_shape = tensor_shape.TensorShape(input_shape[0]).as_list()
+    if self.data_format == 'expanded':
+      del x_shape[2]
+    [B, D, N] = x_shape
+    K = tensor_shape.TensorShape(input_shape[1]).as_list()[1]
+    return tensor_shape.TensorShape([B, K, D, N])
+
+  def build(self, input_shape):
+    self._input_is_expanded = self.data_format == 'expanded'
+    self.built = True
+
+  def call(self, inputs):
+    x, neighborhoods = inputs
+    neighborhoods = _maybe_cast(neighborhoods, tf.int32)
+
+    if self._input_is_expanded:
+      x = _remove_dim(x, 2)
+      neighborhoods = _remove_dim(neighborhoods, 2)
+
+    return _flex_gather(x, neighborhoods)
+
+
+def flex_neighborhood(x,
+                      neighborhoods,
+                      data_format='simple',
+                      name=None):
+
+  layer = FlexNeighborhood(data_format=data_format,
+                           name=name)
+
+  return layer.apply([x, neighborhoods])
+
+
 @tf_export('keras.layers.FlexPooling')
 class FlexPooling(Layer):
   """flex pooling layer.
@@ -50,45 +217,61 @@ class FlexPooling(Layer):
       In contrast to traditional pooling, this operation has no option for
       sub-sampling.
 
+  The layer is called on `[features, neighborhoods]` with features of the
+  format [B, Din, (1), N] and neighborhoods of the format [B, K, (1), N]
+  (tf.int32).
+
   Arguments:
-      features: A `Tensor` of the format [B, Din, (1), N].
-      neighborhoods: A `Tensor` of the format [B, K, (1), N] (tf.int32).
+      data_format: A string, one of `simple` (default) or `expaned`.
+      from_gathered: Boolean, whether the layer is called on the single
+        output [B, K, Din, N] of a `FlexNeighborhood` layer (a tensor or a
+        one-element list) instead of features and neighborhoods.
       name: A string, the name of the layer.
 
   """
 
   def __init__(self,
-               features,
-               neighborhoods,
                data_format='simple',
+               from_gathered=False,
                name=None):
 
     super(FlexPooling, self).__init__(name=name)
-    self.features = features
-    self.neighborhoods = neighborhoods
     self.data_format = data_format
+    self.from_gathered = from_gathered
+    if from_gathered:
+      self.input_spec = _input_spec(1, 'gathered')
+    else:
+      self.input_spec = _input_spec(2, data_format)
+    self._expects_training_arg = False
 
   def compute_output_shape(self, input_shape):
-    return tensor_shape.TensorShape(input_shape)
+    if self.from_gathered:
+      if not isinstance(input_shape, tensor_shape.TensorShape):
+        input_shape = input_shape[0]
+      [B, K, D, N] = tensor_shape.TensorShape(input_shape).as_list()
+      return tensor_shape.TensorShape([B, D, N])
+    return tensor_shape.TensorShape(input_shape[0])
 
   def build(self, input_shape):
+    self._input_is_expanded = self.data_format == 'expanded'
     self.built = True
 
   def call(self, inputs):
-    if not isinstance(inputs, list):
-      raise ValueError('A flexconv layer should be called '
-                       'on a list of inputs.')
+    if self.from_gathered:
+      gathered, = nest.flatten(inputs)
+      return _flex_pooling_from_gathered(_maybe_cast(gathered, self.dtype))
 
-    features = ops.convert_to_tensor(inputs[0], dtype=self.dtype)
-    neighborhoods = ops.convert_to_tensor(inputs[1], dtype=tf.int32)
+    features, neighborhoods = inputs
+    features = _maybe_cast(features, self.dtype)
+    neighborhoods = _maybe_cast(neighborhoods, tf.int32)
 
-    if self.data_format == 'expanded':
+    if self._input_is_expanded:
       features = _remove_dim(features, 2)
       neighborhoods = _remove_dim(neighborhoods, 2)
 
     y, _ = _flex_pooling(features, neighborhoods)
 
-    if self.data_format == 'expanded':
+    if self._input_is_expanded:
       y = tf.expand_dims(y, axis=2)
 
     return y
@@ -99,12 +282,18 @@ def flex_pooling(features,
                  data_format='simple',
                  name=None):
 
-  layer = FlexPooling(features,
-                      neighborhoods,
-                      data_format=data_format,
-                      name=name)
+  # squeeze once at the boundary, the layer itself works on rank-3 tensors
+  if data_format == 'expanded':
+    features, neighborhoods = _remove_dims([features, neighborhoods])
+
+  layer = FlexPooling(name=name)
+
+  y = layer.apply([features, neighborhoods])
+
+  if data_format == 'expanded':
+    y = tf.expand_dims(y, axis=2)
 
-  return layer.apply([features, neighborhoods])
+  return y
 
 
 @tf_export('keras.layers.FlexConvolution')
@@ -116,6 +305,8 @@ class FlexConvolution(Layer):
   If `use_feature_bias` is True (and a `features_bias_initializer` is provided),
   a bias vector is created and added to the outputs after te convolution.
   Finally, if `activation` is not `None`, it is applied to the outputs as well.
+  Both steps are fused into the convolution op for the activations `relu`,
+  `elu` and `sigmoid`.
   When `data_format` is 'simple', the input shape should have rank 3,
   otherwise rank 4 and dimension 2 should be 1.
 
@@ -125,10 +316,12 @@ class FlexConvolution(Layer):
         - bias term when dynamically computing the weight [Din, Dout]
         - bias term which is added tot the features [Dout]
 
+  The layer is called on `[features, positions, neighborhoods]` with
+  features of the format [B, Din, (1), N], positions of the format
+  [B, Dp, (1), N] and neighborhoods of the format [B, K, (1), N] (tf.int32).
+  Din and Dp are inferred from these shapes when the layer is built.
+
   Arguments:
-      features: A `Tensor` of the format [B, Din, (1), N].
-      positions: A `Tensor` of the format [B, Dp, (1), N].
-      neighborhoods: A `Tensor` of the format [B, K, (1), N] (tf.int32).
       filters: Integer, the dimensionality of the output space (i.e. the number
         of filters in the convolution).
       activation: Activation function. Set it to None to maintain a
@@ -143,6 +336,31 @@ class FlexConvolution(Layer):
         If `simple` the shapes are [B, Din, N], when `expanded` the shapes
         are assumed to be [B, Din, 1, N] to match `channels_first` in trad
         convolutions.
+      features_format: A string, one of `NCW` (default) or `NWC`. The memory
+        layout the op reads the features in. `NWC` transposes the features to
+        [B, N, Din] first, such that the channels of each neighbor are
+        contiguous when gathering them. This pays off for large neighborhoods.
+      neighborhoods_sorted: Boolean, whether the points are spatially sorted
+        (e.g. by their Morton code) before computing the neighborhoods. The
+        neighbors of consecutive points are then loaded as a contiguous
+        range instead of being gathered one by one.
+      compute_dtype: The dtype of the inputs and of the computation, e.g.
+        `tf.bfloat16`. The weights are stored in `dtype` and cast once when
+        building the graph. Defaults to `dtype`.
+        With `tf.bfloat16` the op still accumulates in float32 and the
+        gradient is computed in float32.
+      quantize: Boolean, whether to run the convolution with an int8 copy of
+        `position_theta` (scale per output channel). This is meant for
+        inference, as the quantized op has no gradient. It is read when
+        calling the layer, so it can be enabled after training.
+      from_gathered: Boolean, whether the layer is called on the outputs
+        [B, K, Din, N] and [B, K, Dp, N] of two `FlexNeighborhood` layers
+        instead of features, positions and neighborhoods.
+      jit_compile: Boolean, whether to build the ops of a call within an XLA
+        jit scope. The flex op itself has no XLA kernel and stays outside the
+        cluster, but the surrounding transposes, bias and activations are
+        fused by XLA.
+      dtype: The dtype of the weights, float32 by default.
       trainable: Boolean, if `True` also add variables to the graph collection
         `GraphKeys.TRAINABLE_VARIABLES` (see `tf.Variable`).
       name: A string, the name of the layer.
@@ -150,9 +368,6 @@ class FlexConvolution(Layer):
   """
 
   def __init__(self,
-               features,
-               positions,
-               neighborhoods,
                filters,
                activation=None,
                kernel_initializer=None,
@@ -160,41 +375,75 @@ class FlexConvolution(Layer):
                features_bias_initializer=tf.zeros_initializer(),
                use_feature_bias=True,
                data_format='simple',
+               features_format='NCW',
+               neighborhoods_sorted=False,
+               compute_dtype=None,
+               quantize=False,
+               from_gathered=False,
+               jit_compile=False,
+               dtype=tf.float32,
                trainable=True,
                name=None):
 
+    # the weights keep their dtype when the previous layer computes in a
+    # lower precision, instead of inferring it from the inputs
     super(FlexConvolution, self).__init__(trainable=trainable,
-                                          name=name)
-    self.features = features
-    self.positions = positions
-    self.neighborhoods = neighborhoods
-
+                                          name=name,
+                                          dtype=dtype)
     self.filters = int(filters)
     self.activation = activations.get(activation)
+    self._fused_activation = _fused_activation(self.activation)
+    self._activation_fn = _activation_fn(self.activation)
     self.use_feature_bias = use_feature_bias
     self.data_format = data_format
+    self.from_gathered = from_gathered
+    if from_gathered:
+      self.input_spec = _input_spec(2, 'gathered')
+    else:
+      self.input_spec = _input_spec(3, data_format)
+    self._expects_training_arg = False
+    self.features_format = features_format
+    self.neighborhoods_sorted = neighborhoods_sorted
+    self.compute_dtype = compute_dtype
+    if quantize:
+      _require_user_ops('`quantize`')
+    self.quantize = quantize
+    self.jit_compile = jit_compile
     self.kernel_initializer = initializers.get(kernel_initializer)
     self.position_bias_initializer = initializers.get(position_bias_initializer)
     self.features_bias_initializer = initializers.get(features_bias_initializer)
 
   def compute_output_shape(self, input_shape):
-    input_shape = tensor_shape.TensorShape(input_shape)
-    input_shape[1] = self.filters
-    return input_shape
+    output_shape = tensor_shape.TensorShape(input_shape[0]).as_list()
+    if self.from_gathered:
+      # drop the neighbor dimension [B, K, D, N] -> [B, D, N]
+      del output_shape[1]
+    output_shape[1] = self.filters
+    return tensor_shape.TensorShape(output_shape)
 
   def build(self, input_shape):
-    if self.data_format == 'expanded':
-      features = _remove_dim(self.features, 2)
-      positions = _remove_dim(self.positions, 2)
-    else:
-      features = self.features
-      positions = self.positions
-    [B, Din, N] = features.shape
-    Din = int(Din)
-    N = int(N)
-    Dp = int(positions.shape[1])
+    self._input_is_expanded = self.data_format == 'expanded'
+    # the layer dtype is only known once the layer is called
+    self.compute_dtype = tf.as_dtype(self.compute_dtype or self.dtype)
+    features_shape = tensor_shape.TensorShape(input_shape[0])
+    positions_shape = tensor_shape.TensorShape(input_shape[1])
+    # the channels are dimension 1, after the neighbors when gathered
+    axis = 2 if self.from_gathered else 1
+    if features_shape[axis].value is None:
+      raise ValueError('The channel dimension of the features should be '
+                       'defined. Found `None`.')
+    if positions_shape[axis].value is None:
+      raise ValueError('The channel dimension of the positions should be '
+                       'defined. Found `None`.')
+    Din = features_shape[axis].value
+    Dp = positions_shape[axis].value
     Dout = self.filters
 
+    # baked into the op, such that the static shapes do not depend on
+    # inference over the inputs of each call. K is left out, the layer can be
+    # called on neighborhoods of different sizes.
+    self._dims = {'Din': Din, 'Dout': Dout, 'Dp': Dp}
+
     self.position_theta = self.add_weight(
         'position_theta',
         shape=[1, Dp, Din, Dout],
@@ -212,40 +461,111 @@ class FlexConvolution(Layer):
     if self.use_feature_bias:
       self.feature_bias = self.add_weight(
           'feature_bias',
-          shape=[Dout, 1],
+          shape=[Dout],
           initializer=self.features_bias_initializer,
           dtype=self.dtype,
           trainable=True)
     else:
       self.feature_bias = None
+
+    # applied after the transposed op, which has no fused epilogue
+    self._epilogue = _epilogue(self.feature_bias is not None,
+                               self._activation_fn)
+
+    # in graph mode the cast weights are created once and shared by all calls
+    self._compute_weights = None
+    if not tf.executing_eagerly():
+      self._compute_weights = self._cast_weights()
+    # quantized on the first quantized call, as `quantize` may be set later
+    self._quantized_theta = None
     self.built = True
 
+  def _cast_weights(self):
+    """Returns theta, position bias and feature bias in `compute_dtype`."""
+    weights = [self.position_theta, self.position_bias, self.feature_bias]
+    if self.compute_dtype != self.dtype:
+      weights = [None if w is None else tf.cast(w, self.compute_dtype)
+                 for w in weights]
+    return weights
+
+  def _quantized_weights(self, theta):
+    """Returns the int8 theta and its scale, quantized once per graph."""
+    if tf.executing_eagerly():
+      return _quantize_theta(theta)
+    if self._quantized_theta is None:
+      self._quantized_theta = _quantize_theta(theta)
+    return self._quantized_theta
+
   def call(self, inputs):
+    if self.jit_compile:
+      with jit.experimental_jit_scope():
+        return self._call_impl(inputs)
+    return self._call_impl(inputs)
 
-    if not isinstance(inputs, list):
-      raise ValueError('A flexconv layer should be called '
-                       'on a list of inputs.')
+  def _call_impl(self, inputs):
+    if self.from_gathered:
+      return self._call_gathered(inputs)
 
-    features = ops.convert_to_tensor(inputs[0], dtype=self.dtype)
-    positions = ops.convert_to_tensor(inputs[1], dtype=self.dtype)
-    neighborhoods = ops.convert_to_tensor(inputs[2], dtype=tf.int32)
+    features, positions, neighborhoods = inputs
+    features = _maybe_cast(features, self.compute_dtype)
+    positions = _maybe_cast(positions, self.compute_dtype)
+    neighborhoods = _maybe_cast(neighborhoods, tf.int32)
 
-    if self.data_format == 'expanded':
+    if self._input_is_expanded:
       features = _remove_dim(features, 2)
       positions = _remove_dim(positions, 2)
       neighborhoods = _remove_dim(neighborhoods, 2)
 
-    y = _flex_convolution(features, positions, neighborhoods,
-                          self.position_theta, self.position_bias)
+    if self.features_format == 'NWC':
+      features = tf.transpose(features, [0, 2, 1])
+
+    theta, bias, feature_bias = (self._compute_weights or
+                                 self._cast_weights())
+
+    # bias and supported activations are applied within the op
+    fused_activation = self._fused_activation
+    if self.quantize:
+      theta, theta_scale = self._quantized_weights(theta)
+      y = _flex_convolution_int8(features, positions, neighborhoods,
+                                 theta, theta_scale, bias,
+                                 feature_bias=feature_bias,
+                                 activation=fused_activation,
+                                 data_format=self.features_format,
+                                 neighborhood_sorted=self.neighborhoods_sorted,
+                                 dims=self._dims)
+    else:
+      y = _flex_convolution(features, positions, neighborhoods,
+                            theta, bias,
+                            feature_bias=feature_bias,
+                            activation=fused_activation,
+                            data_format=self.features_format,
+                            neighborhood_sorted=self.neighborhoods_sorted,
+                            dims=self._dims)
+
+    if fused_activation is None:
+      y = self._activation_fn(y)
+
+    if self._input_is_expanded:
+      y = tf.expand_dims(y, axis=2)
 
-    if self.use_feature_bias:
-      y = tf.add(y, self.feature_bias)
+    return y
 
-    if self.activation is not None:
-      y = self.activation(y)
+  def _call_gathered(self, inputs):
+    gathered_features, gathered_positions = inputs
+    gathered_features = _maybe_cast(gathered_features, self.compute_dtype)
+    gathered_positions = _maybe_cast(gathered_positions, self.compute_dtype)
 
-    if self.data_format == 'expanded':
-      y = tf.expand_dims(y, axis=2)
+    theta, bias, feature_bias = (self._compute_weights or
+                                 self._cast_weights())
+
+    fused_activation = self._fused_activation
+    y = _flex_convolution_from_gathered(gathered_features, gathered_positions,
+                                        theta, bias,
+                                        feature_bias=feature_bias,
+                                        activation=fused_activation)
+
+    if fused_activation is None:
+      y = self._activation_fn(y)
 
     return y
 
@@ -260,23 +580,39 @@ def flex_convolution(features,
                      features_bias_initializer=tf.zeros_initializer(),
                      use_feature_bias=True,
                      data_format='simple',
+                     features_format='NCW',
+                     neighborhoods_sorted=False,
+                     compute_dtype=None,
+                     quantize=False,
+                     jit_compile=False,
                      trainable=True,
                      name=None):
 
-  layer = FlexConvolution(features,
-                          positions,
-                          neighborhoods,
-                          filters,
+  # squeeze once at the boundary, the layer itself works on rank-3 tensors
+  if data_format == 'expanded':
+    features, positions, neighborhoods = _remove_dims(
+        [features, positions, neighborhoods])
+
+  layer = FlexConvolution(filters,
                           activation=activation,
                           kernel_initializer=kernel_initializer,
                           position_bias_initializer=position_bias_initializer,
                           features_bias_initializer=features_bias_initializer,
                           use_feature_bias=use_feature_bias,
-                          data_format=data_format,
+                          features_format=features_format,
+                          neighborhoods_sorted=neighborhoods_sorted,
+                          compute_dtype=compute_dtype,
+                          quantize=quantize,
+                          jit_compile=jit_compile,
                           trainable=trainable,
                           name=name)
 
-  return layer.apply([features, positions, neighborhoods])
+  y = layer.apply([features, positions, neighborhoods])
+
+  if data_format == 'expanded':
+    y = tf.expand_dims(y, axis=2)
+
+  return y
 
 
 @tf_export('keras.layers.FlexConvolutionTranspose')
@@ -297,10 +633,12 @@ class FlexConvolutionTranspose(FlexConvolution):
         - bias term when dynamically computing the weight [Din, Dout]
         - bias term which is added tot the features [Dout]
 
+  The layer is called on `[features, positions, neighborhoods]` with
+  features of the format [B, Din, (1), N], positions of the format
+  [B, Dp, (1), N] and neighborhoods of the format [B, K, (1), N] (tf.int32).
+  Din and Dp are inferred from these shapes when the layer is built.
+
   Arguments:
-      features: A `Tensor` of the format [B, Din, (1), N].
-      positions: A `Tensor` of the format [B, Dp, (1), N].
-      neighborhoods: A `Tensor` of the format [B, K, (1), N] (tf.int32).
       filters: Integer, the dimensionality of the output space (i.e. the number
         of filters in the convolution).
       activation: Activation function. Set it to None to maintain a
@@ -315,37 +653,55 @@ class FlexConvolutionTranspose(FlexConvolution):
         If `simple` the shapes are [B, Din, N], when `expanded` the shapes
         are assumed to be [B, Din, 1, N] to match `channels_first` in trad
         convolutions.
+      jit_compile: Boolean, whether to build the ops of a call within an XLA
+        jit scope (see `FlexConvolution`).
+      dtype: The dtype of the weights, float32 by default.
       trainable: Boolean, if `True` also add variables to the graph collection
         `GraphKeys.TRAINABLE_VARIABLES` (see `tf.Variable`).
       name: A string, the name of the layer.
 
   """
 
-  def call(self, inputs):
-
-    if not isinstance(inputs, list):
-      raise ValueError('A flexconv layer should be called '
-                       'on a list of inputs.')
-
-    features = ops.convert_to_tensor(inputs[0], dtype=self.dtype)
-    positions = ops.convert_to_tensor(inputs[1], dtype=self.dtype)
-    neighborhoods = ops.convert_to_tensor(inputs[2], dtype=tf.int32)
-
-    if self.data_format == 'expanded':
+  def __init__(self,
+               filters,
+               features_format='NCW',
+               neighborhoods_sorted=False,
+               quantize=False,
+               from_gathered=False,
+               **kwargs):
+    # options of the FlexConv op which the transposed op does not have
+    unsupported = {'features_format': features_format != 'NCW',
+                   'neighborhoods_sorted': neighborhoods_sorted,
+                   'quantize': quantize,
+                   'from_gathered': from_gathered}
+    for option, is_set in sorted(unsupported.items()):
+      if is_set:
+        raise ValueError('FlexConvolutionTranspose does not support `%s`.'
+                         % option)
+    _require_user_ops('FlexConvolutionTranspose')
+    super(FlexConvolutionTranspose, self).__init__(filters, **kwargs)
+
+  def _call_impl(self, inputs):
+    features, positions, neighborhoods = inputs
+    features = _maybe_cast(features, self.compute_dtype)
+    positions = _maybe_cast(positions, self.compute_dtype)
+    neighborhoods = _maybe_cast(neighborhoods, tf.int32)
+
+    if self._input_is_expanded:
       features = _remove_dim(features, 2)
       positions = _remove_dim(positions, 2)
       neighborhoods = _remove_dim(neighborhoods, 2)
 
-    y = _flex_convolution_transpose(features, positions, neighborhoods,
-                                    self.position_theta, self.position_bias)
+    theta, bias, feature_bias = (self._compute_weights or
+                                 self._cast_weights())
 
-    if self.use_feature_bias:
-      y = tf.add(y, self.feature_bias)
+    y = _flex_convolution_transpose(features, positions, neighborhoods,
+                                    theta, bias)
 
-    if self.activation is not None:
-      y = self.activation(y)
+    if self._epilogue is not None:
+      y = self._epilogue(y, feature_bias)
 
-    if self.data_format == 'expanded':
+    if self._input_is_expanded:
       y = tf.expand_dims(y, axis=2)
 
     return y
@@ -361,20 +717,28 @@ def flex_convolution_transpose(features,
                                features_bias_initializer=tf.zeros_initializer(),
                                use_feature_bias=True,
                                data_format='simple',
+                               jit_compile=False,
                                trainable=True,
                                name=None):
 
-  layer = FlexConvolutionTranspose(features,
-                                   positions,
-                                   neighborhoods,
-                                   filters,
+  # squeeze once at the boundary, the layer itself works on rank-3 tensors
+  if data_format == 'expanded':
+    features, positions, neighborhoods = _remove_dims(
+        [features, positions, neighborhoods])
+
+  layer = FlexConvolutionTranspose(filters,
                                    activation=activation,
                                    kernel_initializer=kernel_initializer,
                                    position_bias_initializer=position_bias_initializer,
                                    features_bias_initializer=features_bias_initializer,
                                    use_feature_bias=use_feature_bias,
-                                   data_format=data_format,
+                                   jit_compile=jit_compile,
                                    trainable=trainable,
                                    name=name)
 
-  return layer.apply([features, positions, neighborhoods])
+  y = layer.apply([features, positions, neighborhoods])
+
+  if data_format == 'expanded':
+    y = tf.expand_dims(y, axis=2)
+
+  return y
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 ComputerGraphics Tuebingen. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# Authors: Fabian Groh, Patrick Wieschollek, Hendrik P.A. Lensch
+
+"""CPU fallback of the flex ops when the compiled user_ops are missing.
+
+The ops run through `tf.py_func` on the CPU and have no gradient, they are
+meant for inference and debugging on platforms without a build of the
+user_ops. With numba installed the loops are compiled and run in parallel,
+otherwise vectorized numpy is used.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+try:
+  import numba
+except ImportError:
+  numba = None
+
+
+def _gather(x, neighborhood):
+  # [B, D, N] x [B, K, N] -> [B, K, D, N]
+  B, D, _ = x.shape
+  b = np.arange(B).reshape([-1, 1, 1, 1])
+  d = np.arange(D).reshape([1, 1, -1, 1])
+  return x[b, d, neighborhood[:, :, None, :]]
+
+
+def _flex_pooling_numpy(features, neighborhood):
+  gathered = _gather(features, neighborhood)
+  k = np.argmax(gathered, axis=1)
+
+  B, _, N = neighborhood.shape
+  b = np.arange(B).reshape([-1, 1, 1])
+  n = np.arange(N).reshape([1, 1, -1])
+  argmax = neighborhood[b, k, n].astype(np.int32)
+  return np.max(gathered, axis=1), argmax
+
+
+def _flex_convolution_numpy(features, positions, neighborhood, theta, bias):
+  gathered_features = _gather(features, neighborhood)
+  gathered_positions = _gather(positions, neighborhood)
+
+  # the dynamic weight is linear in the relative position, so the sum over
+  # the neighbors is taken before contracting with theta
+  q = gathered_positions - gathered_positions[:, :1]
+  moments = np.einsum('bkpn,bkdn->bpdn', q, gathered_features)
+  output = np.einsum('bpdn,pdo->bon', moments, theta[0])
+  output += np.einsum('bdn,do->bon', gathered_features.sum(axis=1), bias)
+  return output.astype(features.dtype)
+
+
+if numba is not None:
+
+  @numba.njit(parallel=True)
+  def _flex_pooling_numba(features, neighborhood):
+    B, D, N = features.shape
+    K = neighborhood.shape[1]
+
+    output = np.empty((B, D, N), features.dtype)
+    argmax = np.empty((B, D, N), np.int32)
+
+    for bn in numba.prange(B * N):
+      b = bn // N
+      n = bn % N
+      for d in range(D):
+        winner = neighborhood[b, 0, n]
+        for k in range(1, K):
+          other = neighborhood[b, k, n]
+          if features[b, d, winner] < features[b, d, other]:
+            winner = other
+        output[b, d, n] = features[b, d, winner]
+        argmax[b, d, n] = winner
+
+    return output, argmax
+
+  @numba.njit(parallel=True)
+  def _flex_convolution_numba(features, positions, neighborhood, theta, bias):
+    B, Din, N = features.shape
+    K = neighborhood.shape[1]
+    Dp = theta.shape[1]
+    Dout = theta.shape[3]
+
+    output = np.empty((B, Dout, N), features.dtype)
+
+    for bn in numba.prange(B * N):
+      b = bn // N
+      n = bn % N
+      n0 = neighborhood[b, 0, n]
+
+      # a[dp, din] = sum_k delta_k[dp] * f_k[din], a[Dp, din] = sum_k f_k[din]
+      a = np.zeros((Dp + 1, Din), np.float64)
+      delta = np.empty(Dp, np.float64)
+      for k in range(K):
+        nk = neighborhood[b, k, n]
+        for dp in range(Dp):
+          delta[dp] = positions[b, dp, nk] - positions[b, dp, n0]
+        for din in range(Din):
+          v = features[b, din, nk]
+          for dp in range(Dp):
+            a[dp, din] += delta[dp] * v
+          a[Dp, din] += v
+
+      for dout in range(Dout):
+        acc = 0.
+        for din in range(Din):
+          for dp in range(Dp):
+            acc += a[dp, din] * theta[0, dp, din, dout]
+          acc += a[Dp, din] * bias[din, dout]
+        output[b, dout, n] = acc
+
+    return output
+
+  flex_pooling_cpu = _flex_pooling_numba
+  flex_convolution_cpu = _flex_convolution_numba
+else:
+  flex_pooling_cpu = _flex_pooling_numpy
+  flex_convolution_cpu = _flex_convolution_numpy
+
+
+def flex_pooling(features,
+                 neighborhood,
+                 name=None):
+  """Flex-Pooling computation on the CPU (forward only).
+
+  Args:
+    features: A `Tensor` of the format [B, D, N].
+    neighborhood: A `Tensor` of the format [B, K, N] (tf.int32).
+    name: A name for the operation (optional).
+
+  Returns:
+    A `Tensor` of the format [B, D, N] containing the max values.
+    A `Tensor` of the format [B, D, N] containing the max indicies.
+  """
+
+  with tf.name_scope(name, "flex_pooling_fallback",
+                     [features, neighborhood]):
+    features = tf.convert_to_tensor(features)
+    neighborhood = tf.convert_to_tensor(neighborhood, dtype=tf.int32)
+
+    output, argmax = tf.py_func(flex_pooling_cpu, [features, neighborhood],
+                                [features.dtype, tf.int32], stateful=False)
+    output.set_shape(features.shape)
+    argmax.set_shape(features.shape)
+    return output, argmax
+
+
+def flex_convolution(features,
+                     position,
+                     neighborhood,
+                     theta,
+                     bias,
+                     feature_bias=None,
+                     activation=None,
+                     data_format='NCW',
+                     neighborhood_sorted=False,
+                     dims=None,
+                     name=None):
+  """Flex-Convolution computation on the CPU (forward only).
+
+  Takes the same arguments as `user_ops.flex_convolution`,
+  `neighborhood_sorted` and `dims` only matter for the compiled op.
+  """
+
+  with tf.name_scope(name, "flex_convolution_fallback",
+                     [features, position, neighborhood, theta, bias]):
+    features = tf.convert_to_tensor(features)
+    position = tf.convert_to_tensor(position)
+    neighborhood = tf.convert_to_tensor(neighborhood, dtype=tf.int32)
+    theta = tf.convert_to_tensor(theta)
+    bias = tf.convert_to_tensor(bias)
+
+    if data_format == 'NWC':
+      features = tf.transpose(features, [0, 2, 1])
+
+    y = tf.py_func(flex_convolution_cpu,
+                   [features, position, neighborhood, theta, bias],
+                   features.dtype, stateful=False)
+    y.set_shape([features.shape[0], theta.shape[3], neighborhood.shape[2]])
+
+    if feature_bias is not None:
+      # the CPU kernel supports NCHW for 4D inputs only
+      y = tf.nn.bias_add(tf.expand_dims(y, 2), feature_bias,
+                         data_format='NCHW')
+      y = tf.squeeze(y, axis=2)
+    if activation == 'relu':
+      y = tf.nn.relu(y)
+    elif activation == 'elu':
+      y = tf.nn.elu(y)
+    elif activation == 'sigmoid':
+      y = tf.nn.sigmoid(y)
+    return y
+
+
+def missing_op(name):
+  """Returns a function raising an error for ops without a fallback."""
+
+  def op(*args, **kwargs):
+    raise NotImplementedError('%s requires the compiled user_ops.' % name)
+
+  return op
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2017 ComputerGraphics Tuebingen. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# Authors: Fabian Groh, Patrick Wieschollek, Hendrik P.A. Lensch
+
+"""Flex ops on explicitly gathered neighbors and the quantization of theta.
+
+These are plain TensorFlow ops, they do not need the compiled user_ops and
+are available in the CPU fallback as well.
+"""
+
+import tensorflow as tf
+from tensorflow.python.framework import ops
+
+
+# activations `flex_convolution_from_gathered` applies after the bias
+_ACTIVATIONS = {'none': None,
+                'relu': tf.nn.relu,
+                'elu': tf.nn.elu,
+                'sigmoid': tf.nn.sigmoid}
+
+
+def flex_gather(features, neighborhood, name=None):
+  """Gathers the features of all neighbors of each point.
+
+  The fused ops gather the neighbors internally. Gathering them explicitly
+  pays off when several layers consume the same neighbors, see
+  `flex_pooling_from_gathered` and `flex_convolution_from_gathered`.
+
+  Args:
+    features: A `Tensor` of the format [B, D, N].
+    neighborhood: A `Tensor` of the format [B, K, N] (tf.int32).
+    name: A name for the operation (optional).
+
+  Returns:
+    A `Tensor` of the format [B, K, D, N].
+  """
+
+  with ops.name_scope(name, "flex_gather"):
+    features = ops.convert_to_tensor(features)
+    neighborhood = ops.convert_to_tensor(neighborhood, dtype=tf.int32)
+
+    shape = tf.shape(neighborhood)
+    batch = tf.tile(tf.reshape(tf.range(shape[0]), [-1, 1, 1]),
+                    [1, shape[1], shape[2]])
+    indices = tf.stack([batch, neighborhood], axis=-1)
+    gathered = tf.gather_nd(tf.transpose(features, [0, 2, 1]), indices)
+    return tf.transpose(gathered, [0, 1, 3, 2])
+
+
+def flex_pooling_from_gathered(gathered_features, name=None):
+  """Flex-Pooling computation on gathered neighbor features.
+
+  Args:
+    gathered_features: A `Tensor` of the format [B, K, D, N].
+    name: A name for the operation (optional).
+
+  Returns:
+    A `Tensor` of the format [B, D, N] containing the max values.
+  """
+
+  with ops.name_scope(name, "flex_pooling_from_gathered"):
+    return tf.reduce_max(gathered_features, axis=1)
+
+
+def flex_convolution_from_gathered(gathered_features,
+                                   gathered_position,
+                                   theta,
+                                   bias,
+                                   feature_bias=None,
+                                   activation=None,
+                                   name=None):
+  """Flex-Convolution computation on gathered neighbors.
+
+  Same result as `flex_convolution`. The sum over the neighbors is taken
+  before contracting with theta and bias (the dynamic weight is linear in the
+  relative position), such that both steps are plain tensor contractions.
+
+  Args:
+    gathered_features: A `Tensor` of the format [B, K, Din, N].
+    gathered_position: A `Tensor` of the format [B, K, Dp, N].
+    theta: A `Tensor` of the format [1, Dp, Din, Dout].
+    bias: A `Tensor` of the format [Din, Dout].
+    feature_bias: A `Tensor` of the format [Dout] (optional).
+    activation: One of 'none', 'relu', 'elu', 'sigmoid' or None (optional).
+    name: A name for the operation (optional).
+
+  Returns:
+    A `Tensor` of the format [B, Dout, N].
+  """
+
+  if activation is None:
+    activation = 'none'
+  if activation not in _ACTIVATIONS:
+    raise ValueError('Activation "%s" is not supported, expected one of %s.'
+                     % (activation, ', '.join(sorted(_ACTIVATIONS))))
+
+  with ops.name_scope(name, "flex_convolution_from_gathered"):
+    gathered_features = ops.convert_to_tensor(gathered_features)
+    gathered_position = ops.convert_to_tensor(gathered_position)
+
+    # position relative to the point itself (first neighbor) and a constant
+    # slot which the bias is the weight of
+    q = gathered_position - gathered_position[:, :1]
+    q = tf.concat([q, tf.ones_like(q[:, :, :1])], axis=2)
+    moments = tf.einsum('bkpn,bkdn->bpdn', q, gathered_features)
+
+    shape = tf.shape(moments)
+    moments = tf.reshape(moments, [shape[0], -1, shape[3]])
+    weights = tf.concat([theta[0], tf.expand_dims(bias, 0)], axis=0)
+    weights = tf.reshape(weights, [-1, tf.shape(weights)[2]])
+    y = tf.einsum('bcn,co->bon', moments, weights)
+
+    if feature_bias is not None:
+      # the CPU kernel supports NCHW for 4D inputs only
+      y = tf.nn.bias_add(tf.expand_dims(y, 2), feature_bias,
+                         data_format='NCHW')
+      y = tf.squeeze(y, axis=2)
+    if _ACTIVATIONS[activation] is not None:
+      y = _ACTIVATIONS[activation](y)
+    return y
+
+
+def quantize_theta(theta, name=None):
+  """Symmetric int8 quantization of theta with a scale per output channel.
+
+  Args:
+    theta: A `Tensor` of the format [1, Dp, Din, Dout].
+    name: A name for the operation (optional).
+
+  Returns:
+    A `Tensor` of the format [1, Dp, Din, Dout] (tf.int8).
+    A `Tensor` of the format [Dout] containing the scales.
+  """
+
+  with ops.name_scope(name, "quantize_theta"):
+    theta = ops.convert_to_tensor(theta)
+    scale = tf.reduce_max(tf.abs(theta), axis=[0, 1, 2]) / 127.
+    scale = tf.where(scale > 0, scale, tf.ones_like(scale))
+    quantized = tf.cast(tf.round(theta / scale), tf.int8)
+    return quantized, scale
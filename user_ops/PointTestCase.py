@@ -18,9 +18,15 @@
 # Authors: Fabian Groh, Patrick Wieschollek, Hendrik P.A. Lensch
 
 
+import os
+import sys
+
 import numpy as np
 import tensorflow as tf
 
+# the plain TensorFlow ops and the CPU fallback live next to `layers.py`
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
 np.random.seed(42)
 tf.set_random_seed(42)
 
@@ -116,6 +122,7 @@ class PointTestCase(tf.test.TestCase):
 
         self.theta = random_values([1, data.Dp, data.Din, data.Dout])
         self.bias = random_values([data.Din, data.Dout])
+        self.feature_bias = random_values([data.Dout]) - 0.5
 
         super(PointTestCase, self).__init__(methodName)
 
@@ -128,3 +135,4 @@ class PointTestCase(tf.test.TestCase):
         self.neighborhood_ds_op = tf.convert_to_tensor(self.neighborhood_ds)
         self.theta_op = tf.convert_to_tensor(self.theta)
         self.bias_op = tf.convert_to_tensor(self.bias)
+        self.feature_bias_op = tf.convert_to_tensor(self.feature_bias)
@@ -20,6 +20,9 @@ from __future__ import print_function
 
 import tensorflow as tf
 from tensorflow.python.framework import ops
+from tensorflow.python.ops import gen_math_ops
+from tensorflow.python.ops import gen_nn_ops
+from tensorflow.python.util import compat
 from tensorflow.contrib.util import loader
 from tensorflow.python.platform import resource_loader
 
@@ -36,40 +39,90 @@ _flex_deconvolution_op_so = loader.load_op_library(
 # undocumented version
 flex_conv = _flex_convolution_op_so.flex_conv
 flex_conv_grad = _flex_convolution_op_so.flex_conv_grad
+flex_conv_int8 = _flex_convolution_op_so.flex_conv_int8
 flex_pool = _flex_pooling_op_so.flex_pool
 flex_pool_grad = _flex_pooling_op_so.flex_pool_grad
 flex_deconv = _flex_deconvolution_op_so.flex_deconv
 flex_deconv_grad = _flex_deconvolution_op_so.flex_deconv_grad
 
 
+# activations which can be fused into the epilogue of the FlexConv op
+FUSED_ACTIVATIONS = ('none', 'relu', 'elu', 'sigmoid')
+
+
 # pylint: disable=redefined-builtin
 def flex_convolution(features,
                      position,
                      neighborhood,
                      theta,
                      bias,
+                     feature_bias=None,
+                     activation=None,
+                     data_format='NCW',
+                     neighborhood_sorted=False,
+                     dims=None,
                      name=None):
   """Flex-Convolution computation.
 
   Computes a convolution over arbitrary neighborhoods with elements of
   arbitrary positions:
 
-    output(c', l) = sum_{c} sum_{l'}  w(c, l, l') * f(c, l')
+    output(c', l) = act(sum_{c} sum_{l'}  w(c, l, l') * f(c, l') + b(c'))
+
+  The feature bias and the activation are applied inside the kernel right
+  before the output is written.
 
   Args:
-    features: A `Tensor` of the format [B, Din, N].
+    features: A `Tensor` of the format [B, Din, N] ('NCW') or [B, N, Din]
+      ('NWC').
     position: A `Tensor` of the format [B, Dp, N].
     neighborhood: A `Tensor` of the format [B, K, N] (tf.int32).
     theta: A `Tensor` of the format [1, Dp, Din, Dout].
     bias: A `Tensor` of the format [Din, Dout].
+    feature_bias: A `Tensor` of the format [Dout] (optional).
+    activation: One of `FUSED_ACTIVATIONS` or None (optional).
+    data_format: Layout of the features, either 'NCW' or 'NWC'. The latter
+      stores the channels of each point contiguously, which is faster to
+      gather from for each neighbor.
+    neighborhood_sorted: Whether the points are spatially sorted (e.g. by
+      their Morton code), such that the neighbors of consecutive points lie
+      in a small range of indices. The GPU kernel then loads this range
+      coalesced instead of gathering each neighbor.
+    dims: A dict with any of the keys 'Din', 'Dout', 'K' and 'Dp' holding
+      dimensions known when building the graph (optional). They complete
+      the static output shape and are checked against the inputs.
     name: A name for the operation (optional).
 
   Returns:
     A `Tensor` of the format [B, Dout, N].
   """
 
+  if activation is None:
+    activation = 'none'
+  if activation not in FUSED_ACTIVATIONS:
+    raise ValueError('Activation "%s" cannot be fused, expected one of %s.'
+                     % (activation, ', '.join(FUSED_ACTIVATIONS)))
+
   with ops.name_scope(name, "flex_convolution"):
-    return flex_conv(features, theta, bias, neighborhood, position)
+    theta = ops.convert_to_tensor(theta)
+    if feature_bias is None:
+      feature_bias = tf.zeros(tf.shape(theta)[3:], dtype=theta.dtype)
+    return flex_conv(features, theta, bias, neighborhood, position,
+                     feature_bias, activation=activation,
+                     data_format=data_format,
+                     neighborhood_sorted=neighborhood_sorted,
+                     **(dims or {}))
+
+
+def _fused_activation_grad(activation, output, topdiff):
+  """Backpropagates through the activation fused into the forward op."""
+  if activation == 'relu':
+    return gen_nn_ops.relu_grad(topdiff, output)
+  if activation == 'elu':
+    return gen_nn_ops.elu_grad(topdiff, output)
+  if activation == 'sigmoid':
+    return gen_math_ops.sigmoid_grad(output, topdiff)
+  return topdiff
 
 
 @ops.RegisterGradient("FlexConv")
@@ -81,14 +134,99 @@ def _FlexConvGrad(op, *grads):  # noqa
   positions = ops.convert_to_tensor(op.inputs[4])
   topdiff = ops.convert_to_tensor(grads[0])
 
+  output = op.outputs[0]
+
+  # there are no bfloat16 backward kernels (neither of the activations), the
+  # gradient is computed in float
+  dtype = features.dtype
+  if dtype == tf.bfloat16:
+    features, theta, bias, positions, output, topdiff = [
+        tf.cast(x, tf.float32)
+        for x in [features, theta, bias, positions, output, topdiff]]
+
+  activation = compat.as_str(op.get_attr('activation'))
+  topdiff = _fused_activation_grad(activation, output, topdiff)
+
+  # the backward kernels expect the features in NCW
+  features_nwc = compat.as_str(op.get_attr('data_format')) == 'NWC'
+  if features_nwc:
+    features = tf.transpose(features, [0, 2, 1])
+
   df, dt, db = flex_conv_grad(
       features, theta, bias, neighborhood, positions, topdiff)
 
+  if features_nwc:
+    df = tf.transpose(df, [0, 2, 1])
+
+  dfb = tf.reduce_sum(topdiff, axis=[0, 2])
+
+  if dtype == tf.bfloat16:
+    df, dt, db, dfb = [tf.cast(x, dtype) for x in [df, dt, db, dfb]]
+
   df = ops.convert_to_tensor(df, name='gradient_features')
   dt = ops.convert_to_tensor(dt, name='gradient_theta')
   db = ops.convert_to_tensor(db, name='gradient_bias')
+  dfb = ops.convert_to_tensor(dfb, name='gradient_feature_bias')
 
-  return [df, dt, db, None, None]
+  return [df, dt, db, None, None, dfb]
+
+
+# pylint: disable=redefined-builtin
+def flex_convolution_int8(features,
+                          position,
+                          neighborhood,
+                          theta,
+                          theta_scale,
+                          bias,
+                          feature_bias=None,
+                          activation=None,
+                          data_format='NCW',
+                          neighborhood_sorted=False,
+                          dims=None,
+                          name=None):
+  """Flex-Convolution computation with an int8 quantized theta.
+
+  Same as `flex_convolution` but theta is given as int8 together with a scale
+  per output channel (see `layers_gather.quantize_theta`). Meant for
+  inference only, there is no gradient.
+
+  Args:
+    features: A `Tensor` of the format [B, Din, N] ('NCW') or [B, N, Din]
+      ('NWC').
+    position: A `Tensor` of the format [B, Dp, N].
+    neighborhood: A `Tensor` of the format [B, K, N] (tf.int32).
+    theta: A `Tensor` of the format [1, Dp, Din, Dout] (tf.int8).
+    theta_scale: A `Tensor` of the format [Dout].
+    bias: A `Tensor` of the format [Din, Dout].
+    feature_bias: A `Tensor` of the format [Dout] (optional).
+    activation: One of `FUSED_ACTIVATIONS` or None (optional).
+    data_format: Layout of the features, either 'NCW' or 'NWC'.
+    neighborhood_sorted: Whether the points are spatially sorted.
+    dims: Dimensions known when building the graph (optional).
+    name: A name for the operation (optional).
+
+  Returns:
+    A `Tensor` of the format [B, Dout, N].
+  """
+
+  if activation is None:
+    activation = 'none'
+  if activation not in FUSED_ACTIVATIONS:
+    raise ValueError('Activation "%s" cannot be fused, expected one of %s.'
+                     % (activation, ', '.join(FUSED_ACTIVATIONS)))
+
+  with ops.name_scope(name, "flex_convolution_int8"):
+    theta_scale = ops.convert_to_tensor(theta_scale)
+    if feature_bias is None:
+      feature_bias = tf.zeros_like(theta_scale)
+    return flex_conv_int8(features, theta, bias, neighborhood, position,
+                          feature_bias, theta_scale, activation=activation,
+                          data_format=data_format,
+                          neighborhood_sorted=neighborhood_sorted,
+                          **(dims or {}))
+
+
+ops.NotDifferentiable("FlexConvInt8")
 
 
 # pylint: disable=redefined-builtin
@@ -14,6 +14,13 @@ limitations under the License.
 ==============================================================================*/
 //Authors: Fabian Groh, Patrick Wieschollek, Hendrik P.A. Lensch
 
+#include <algorithm>
+#include <vector>
+
+#ifdef __AVX512F__
+#include <immintrin.h>
+#endif
+
 #include "flex_conv_op.h"
 #include "tensorflow/core/framework/op.h"
 
@@ -21,55 +28,258 @@ namespace tensorflow {
 
 namespace functor {
 
+namespace {
+
+// Contracts the neighbor moments of a block of points with the packed
+// weights: result[n, :] += sum_c a[n, c] * w[c, :] for C = (Dp + 1) * Din.
+// Each row of w is read once per block, the innermost loop runs over the
+// contiguous Dout dimension of w and result.
+template <typename Acc>
+void ContractMoments(const Acc* a, int C, const Acc* w, int Dout, int num_n,
+                     Acc* result) {
+  for (int c = 0; c < C; ++c) {
+    const Acc* w_c = &w[c * Dout];
+    for (int n_ = 0; n_ < num_n; ++n_) {
+      const Acc a_nc = a[n_ * C + c];
+      Acc* result_n = &result[n_ * Dout];
+      for (int dout = 0; dout < Dout; ++dout) {
+        result_n[dout] += a_nc * w_c[dout];
+      }
+    }
+  }
+}
+
+#ifdef __AVX512F__
+// Same as above with Dout split into 16-wide chunks. Four points share each
+// load of a weight chunk and give four independent FMA chains.
+template <>
+void ContractMoments<float>(const float* a, int C, const float* w, int Dout,
+                            int num_n, float* result) {
+  const int Dout16 = Dout & ~15;
+  const __mmask16 tail = (1 << (Dout - Dout16)) - 1;
+
+  for (int c = 0; c < C; ++c) {
+    const float* w_c = &w[c * Dout];
+    int n_ = 0;
+    for (; n_ + 4 <= num_n; n_ += 4) {
+      const __m512 a0 = _mm512_set1_ps(a[(n_ + 0) * C + c]);
+      const __m512 a1 = _mm512_set1_ps(a[(n_ + 1) * C + c]);
+      const __m512 a2 = _mm512_set1_ps(a[(n_ + 2) * C + c]);
+      const __m512 a3 = _mm512_set1_ps(a[(n_ + 3) * C + c]);
+      float* r0 = &result[(n_ + 0) * Dout];
+      float* r1 = &result[(n_ + 1) * Dout];
+      float* r2 = &result[(n_ + 2) * Dout];
+      float* r3 = &result[(n_ + 3) * Dout];
+
+      for (int dout = 0; dout < Dout16; dout += 16) {
+        const __m512 w_ = _mm512_loadu_ps(&w_c[dout]);
+        _mm512_storeu_ps(&r0[dout],
+                         _mm512_fmadd_ps(a0, w_, _mm512_loadu_ps(&r0[dout])));
+        _mm512_storeu_ps(&r1[dout],
+                         _mm512_fmadd_ps(a1, w_, _mm512_loadu_ps(&r1[dout])));
+        _mm512_storeu_ps(&r2[dout],
+                         _mm512_fmadd_ps(a2, w_, _mm512_loadu_ps(&r2[dout])));
+        _mm512_storeu_ps(&r3[dout],
+                         _mm512_fmadd_ps(a3, w_, _mm512_loadu_ps(&r3[dout])));
+      }
+      if (tail) {
+        const __m512 w_ = _mm512_maskz_loadu_ps(tail, &w_c[Dout16]);
+        _mm512_mask_storeu_ps(
+            &r0[Dout16], tail,
+            _mm512_fmadd_ps(a0, w_, _mm512_maskz_loadu_ps(tail, &r0[Dout16])));
+        _mm512_mask_storeu_ps(
+            &r1[Dout16], tail,
+            _mm512_fmadd_ps(a1, w_, _mm512_maskz_loadu_ps(tail, &r1[Dout16])));
+        _mm512_mask_storeu_ps(
+            &r2[Dout16], tail,
+            _mm512_fmadd_ps(a2, w_, _mm512_maskz_loadu_ps(tail, &r2[Dout16])));
+        _mm512_mask_storeu_ps(
+            &r3[Dout16], tail,
+            _mm512_fmadd_ps(a3, w_, _mm512_maskz_loadu_ps(tail, &r3[Dout16])));
+      }
+    }
+
+    // remaining points of the block
+    for (; n_ < num_n; ++n_) {
+      const __m512 a_nc = _mm512_set1_ps(a[n_ * C + c]);
+      float* r = &result[n_ * Dout];
+      for (int dout = 0; dout < Dout16; dout += 16) {
+        _mm512_storeu_ps(&r[dout],
+                         _mm512_fmadd_ps(a_nc, _mm512_loadu_ps(&w_c[dout]),
+                                         _mm512_loadu_ps(&r[dout])));
+      }
+      if (tail) {
+        _mm512_mask_storeu_ps(
+            &r[Dout16], tail,
+            _mm512_fmadd_ps(a_nc, _mm512_maskz_loadu_ps(tail, &w_c[Dout16]),
+                            _mm512_maskz_loadu_ps(tail, &r[Dout16])));
+      }
+    }
+  }
+}
+#endif  // __AVX512F__
+
+// Forward pass on the weights packed as w(dp, din, dout) with Dp + 1 slots,
+// the last slot holds the position bias (see FlexConvFunctor).
+template <typename Dtype, typename Acc>
+void FlexConvForwardPacked(
+    const Tensor& features_, const std::vector<Acc>& w, int Din,
+    const Tensor& neighborhood_, const Tensor& positions_,
+    const Tensor& feature_bias_, const FlexConvOptions& options,
+    Tensor* output_) {
+  const auto features = features_.tensor<Dtype, 3>();
+  const auto neighborhood = neighborhood_.tensor<int, 3>();
+  const auto positions = positions_.tensor<Dtype, 3>();
+  const auto feature_bias = feature_bias_.tensor<Dtype, 1>();
+
+  auto output = output_->tensor<Dtype, 3>();
+
+  // get dimensions
+  const int B = neighborhood_.dim_size(0);
+  const int K = neighborhood_.dim_size(1);
+  const int N = neighborhood_.dim_size(2);
+  const int Dp = positions_.dim_size(1);
+  const int Dout = output_->dim_size(1);
+
+  // Points are processed in blocks of C_N. The contraction of a block runs
+  // with the weights in the outer loop, such that each weight row is read
+  // once per block and stays in L1 (see ContractMoments).
+  const int C_N = 64;
+  const int C_A = (Dp + 1) * Din;
+  std::vector<Acc> a(C_N * C_A);
+  std::vector<Acc> result(C_N * Dout);
+  std::vector<Acc> delta(Dp);
+
+  for (int b = 0; b < B; ++b) {
+    for (int o_n = 0; o_n < N; o_n += C_N) {
+      const int num_n = std::min(C_N, N - o_n);
+      std::fill(a.begin(), a.end(), Acc(0));
+      std::fill(result.begin(), result.end(), Acc(0));
+
+      for (int n_ = 0; n_ < num_n; ++n_) {
+        const int n = o_n + n_;
+        Acc* a_n = &a[n_ * C_A];
+
+        const int n0 = neighborhood(b, 0, n);
+        for (int k_ = 0; k_ < K; ++k_) {
+          int k = neighborhood(b, k_, n);
+
+          // the relative position only depends on the neighbor
+          for (int dp = 0; dp < Dp; ++dp) {
+            delta[dp] = static_cast<Acc>(positions(b, dp, k)) -
+                        static_cast<Acc>(positions(b, dp, n0));
+          }
+
+          for (int din = 0; din < Din; ++din) {
+            const Acc v = static_cast<Acc>(
+                options.features_nwc ? features(b, k, din)
+                                     : features(b, din, k));
+            for (int dp = 0; dp < Dp; ++dp) {
+              a_n[dp * Din + din] += delta[dp] * v;
+            }
+            a_n[Dp * Din + din] += v;
+          }
+        }
+      }
+
+      ContractMoments<Acc>(a.data(), C_A, w.data(), Dout, num_n,
+                           result.data());
+
+      // epilogue: feature bias and activation
+      for (int dout = 0; dout < Dout; ++dout) {
+        for (int n_ = 0; n_ < num_n; ++n_) {
+          output(b, dout, o_n + n_) =
+              static_cast<Dtype>(FlexConvActivate<Acc>(
+                  result[n_ * Dout + dout] +
+                      static_cast<Acc>(feature_bias(dout)),
+                  options.activation));
+        }
+      }
+    }
+  }
+}
+
+}  // namespace
+
 template <typename Dtype>
 struct FlexConvFunctor<CPUDevice, Dtype> {
+  typedef typename FlexConvAccumulator<Dtype>::type Acc;
+
   void operator()(::tensorflow::OpKernelContext* ctx, const Tensor& features_,
                   const Tensor& theta_, const Tensor& bias_,
                   const Tensor& neighborhood_, const Tensor& positions_,
+                  const Tensor& feature_bias_, const FlexConvOptions& options,
                   Tensor* output_) {
-    const auto features = features_.tensor<Dtype, 3>();
     const auto theta = theta_.tensor<Dtype, 4>();
     const auto bias = bias_.tensor<Dtype, 2>();
-    const auto neighborhood = neighborhood_.tensor<int, 3>();
-    const auto positions = positions_.tensor<Dtype, 3>();
 
-    auto output = output_->tensor<Dtype, 3>();
-
-    // get dimensions
-    const int B = neighborhood_.dim_size(0);
-    const int K = neighborhood_.dim_size(1);
-    const int N = neighborhood_.dim_size(2);
     const int Dp = theta_.dim_size(1);
     const int Din = theta_.dim_size(2);
     const int Dout = theta_.dim_size(3);
 
-    output.setZero();
+    // The dynamic weight is linear in the relative position, so the sum over
+    // the neighbors is taken first: a(dp, din) = sum_k delta_k(dp) * f_k(din)
+    // and a(Dp, din) = sum_k f_k(din). Only this small [Dp + 1, Din] matrix
+    // is contracted with the weights afterwards.
+    //
+    // The bias acts as theta of an extra position that is constant one. Both
+    // are packed once into w(dp, din, dout) with Dp + 1 slots, so the
+    // contraction has no separate bias term.
+    std::vector<Acc> w((Dp + 1) * Din * Dout);
+    for (int din = 0; din < Din; ++din) {
+      for (int dout = 0; dout < Dout; ++dout) {
+        for (int dp = 0; dp < Dp; ++dp) {
+          w[(dp * Din + din) * Dout + dout] =
+              static_cast<Acc>(theta(0, dp, din, dout));
+        }
+        w[(Dp * Din + din) * Dout + dout] = static_cast<Acc>(bias(din, dout));
+      }
+    }
 
-    for (int b = 0; b < B; ++b) {
-      for (int n = 0; n < N; ++n) {
-        for (int k_ = 0; k_ < K; ++k_) {
-          int k = neighborhood(b, k_, n);
+    FlexConvForwardPacked<Dtype>(features_, w, Din, neighborhood_,
+                                 positions_, feature_bias_, options, output_);
+  }
+};
 
-          for (int dout = 0; dout < Dout; ++dout) {
-            for (int din = 0; din < Din; ++din) {
-              const Dtype v = features(b, din, k);
+template struct FlexConvFunctor<CPUDevice, float>;
+template struct FlexConvFunctor<CPUDevice, bfloat16>;
 
-              Dtype W = bias(din, dout);
-              for (int dp = 0; dp < Dp; ++dp) {
-                Dtype delta = positions(b, dp, k) -
-                              positions(b, dp, neighborhood(b, 0, n));
-                W += theta(0, dp, din, dout) * delta;
-              }
-              output(b, dout, n) = output(b, dout, n) + W * v;
-            }
-          }
+template <typename Dtype>
+struct FlexConvQuantizedFunctor<CPUDevice, Dtype> {
+  typedef typename FlexConvAccumulator<Dtype>::type Acc;
+
+  void operator()(::tensorflow::OpKernelContext* ctx, const Tensor& features_,
+                  const Tensor& theta_, const Tensor& theta_scale_,
+                  const Tensor& bias_, const Tensor& neighborhood_,
+                  const Tensor& positions_, const Tensor& feature_bias_,
+                  const FlexConvOptions& options, Tensor* output_) {
+    const auto theta = theta_.tensor<int8, 4>();
+    const auto theta_scale = theta_scale_.tensor<Dtype, 1>();
+    const auto bias = bias_.tensor<Dtype, 2>();
+
+    const int Dp = theta_.dim_size(1);
+    const int Din = theta_.dim_size(2);
+    const int Dout = theta_.dim_size(3);
+
+    // theta is dequantized directly into the packed weights
+    std::vector<Acc> w((Dp + 1) * Din * Dout);
+    for (int din = 0; din < Din; ++din) {
+      for (int dout = 0; dout < Dout; ++dout) {
+        const Acc scale = static_cast<Acc>(theta_scale(dout));
+        for (int dp = 0; dp < Dp; ++dp) {
+          w[(dp * Din + din) * Dout + dout] =
+              static_cast<Acc>(theta(0, dp, din, dout)) * scale;
         }
+        w[(Dp * Din + din) * Dout + dout] = static_cast<Acc>(bias(din, dout));
       }
     }
+
+    FlexConvForwardPacked<Dtype>(features_, w, Din, neighborhood_,
+                                 positions_, feature_bias_, options, output_);
   }
 };
 
-template struct FlexConvFunctor<CPUDevice, float>;
+template struct FlexConvQuantizedFunctor<CPUDevice, float>;
 
 template <typename Dtype>
 struct FlexConvGrad<CPUDevice, Dtype> {
@@ -19,6 +19,7 @@ limitations under the License.
 #define EIGEN_USE_GPU
 
 #include <cub/cub.cuh>
+#include <type_traits>
 
 #include "flex_conv_op.h"
 #include "tensorflow/core/util/cuda_kernel_helper.h"
@@ -29,53 +30,157 @@ using CudaLaunchConfig = ::tensorflow::CudaLaunchConfig;
 
 constexpr __host__ __device__ int pmin(int x, int y) { return x <= y ? x : y; }
 
+// read through the read-only cache where the intrinsic supports the type
+template <typename T>
+__device__ __forceinline__ T ldg(const T* p) {
+  return *p;
+}
+
+template <>
+__device__ __forceinline__ float ldg(const float* p) {
+  return __ldg(p);
+}
+
+// Relative position of each neighbor to its center point, stored as
+// [B, Dp, K, N]. Consecutive threads handle consecutive points, such that the
+// writes here and the reads in the forward kernel are coalesced along N.
+//
+// The forward kernel still reads the K * Dp values of a point once per input
+// channel, as they do not fit into registers or shared memory for large K.
+// Without this buffer, each of these reads was a gather of the neighbor
+// position plus the position of the point itself. The extra write and read of
+// [B, Dp, K, N] is small against the K * Din feature reads of the forward.
+template <typename Dtype, typename NBtype, int Dp>
+__global__ void RelPositionsKernel(
+    const Dtype* d_positions, const NBtype* d_neighborhood, int K, int N,
+    typename ::tensorflow::functor::FlexConvAccumulator<Dtype>::type*
+        d_rel_positions) {
+  typedef typename ::tensorflow::functor::FlexConvAccumulator<Dtype>::type Acc;
+
+  const int b = blockIdx.z;
+  const int k = blockIdx.y;
+  const int n = blockIdx.x * blockDim.x + threadIdx.x;
+  if (n >= N) return;
+
+  const NBtype n0 = d_neighborhood[b * K * N + n];
+  const NBtype nk = d_neighborhood[b * K * N + k * N + n];
+
+#pragma unroll
+  for (int dp = 0; dp < Dp; ++dp) {
+    d_rel_positions[((b * Dp + dp) * K + k) * N + n] =
+        static_cast<Acc>(d_positions[b * Dp * N + dp * N + nk]) -
+        static_cast<Acc>(d_positions[b * Dp * N + dp * N + n0]);
+  }
+}
+
 template <typename Dtype, typename NBtype, int Dp = 3, int C_N = 256,
-          int C_Dout = 32, int C_Din = 64>
+          int C_Dout = 32, int C_Din = 64, bool FeaturesNWC = false,
+          bool Sorted = false, typename Ttheta = Dtype>
 struct ForwardKernel;
 
 template <typename Dtype, typename NBtype, int Dp, int C_N, int C_Dout,
-          int C_Din>
+          int C_Din, bool FeaturesNWC, bool Sorted, typename Ttheta>
 __global__ void runForwardKernel(
-    const ForwardKernel<Dtype, NBtype, Dp, C_N, C_Dout, C_Din> kernel) {
+    const ForwardKernel<Dtype, NBtype, Dp, C_N, C_Dout, C_Din, FeaturesNWC,
+                        Sorted, Ttheta>
+        kernel) {
   kernel();
 }
 
 template <typename Dtype, typename NBtype, int Dp, int C_N, int C_Dout,
-          int C_Din>
+          int C_Din, bool FeaturesNWC, bool Sorted, typename Ttheta>
 struct ForwardKernel {
+  typedef typename ::tensorflow::functor::FlexConvAccumulator<Dtype>::type Acc;
+
   enum {
-    PMIN = 3  // only for unrolling
+    C_Window = 2 * C_N  // max. range of staged neighbors (sorted only)
   };
 
   void launch(int B) {
     dim3 block(C_N);
     dim3 grid((N - 1) / C_N + 1, (Dout - 1) / C_Dout + 1, B);
 
-    size_t shm_size = (Dp + 1) * C_Din * C_Dout * sizeof(Dtype);
+    size_t shm_size = (Dp + 1) * C_Din * C_Dout * sizeof(Acc);
+    if (Sorted) shm_size += C_Din * C_Window * sizeof(Acc);
 
     runForwardKernel<<<grid, block, shm_size>>>((*this));
   }
 
+  // In NWC layout the Din channels of a neighbor are contiguous, such that
+  // the din-loop below reads consecutive addresses through the read-only
+  // cache instead of jumping N elements per channel.
+  __device__ __forceinline__ Acc feature(int b, int din, int nk) const {
+    if (FeaturesNWC)
+      return static_cast<Acc>(ldg(&d_features[(b * N + nk) * Din + din]));
+    return static_cast<Acc>(d_features[b * Din * N + din * N + nk]);
+  }
+
+  __device__ __forceinline__ Acc rel_position(int b, int dp, int k,
+                                              int n) const {
+    return ldg(&d_rel_positions[((b * Dp + dp) * K + k) * N + n]);
+  }
+
+  // Quantized theta (int8) is scaled per output channel while it is copied
+  // into shared memory, the inner loops always run on Acc.
+  __device__ __forceinline__ Acc theta(int i, int g_dout) const {
+    if (std::is_same<Ttheta, Dtype>::value)
+      return static_cast<Acc>(d_theta[i]);
+    return static_cast<Acc>(d_theta[i]) *
+           static_cast<Acc>(d_theta_scale[g_dout]);
+  }
+
+  // For spatially sorted point clouds (e.g. Morton order) the neighbors of
+  // the C_N consecutive points of a block lie in a small contiguous range.
+  // Returns whether this range fits into the feature staging buffer and its
+  // start.
+  __device__ __forceinline__ bool neighbor_window(int b, int n, int* lo) const {
+    typedef cub::BlockReduce<int, C_N> BlockReduce;
+    __shared__ typename BlockReduce::TempStorage temp_storage;
+    __shared__ int s_lo;
+    __shared__ int s_hi;
+
+    int t_lo = N;
+    int t_hi = -1;
+    for (int k = 0; k < K && n < N; ++k) {
+      const int nk = d_neighborhood[b * K * N + k * N + n];
+      t_lo = min(t_lo, nk);
+      t_hi = max(t_hi, nk);
+    }
+
+    int aggregate = BlockReduce(temp_storage).Reduce(t_lo, cub::Min());
+    if (!threadIdx.x) s_lo = aggregate;
+    __syncthreads();
+    aggregate = BlockReduce(temp_storage).Reduce(t_hi, cub::Max());
+    if (!threadIdx.x) s_hi = aggregate;
+    __syncthreads();
+
+    *lo = s_lo;
+    return s_hi - s_lo < C_Window;
+  }
+
   __device__ __forceinline__ void operator()() const {
-    extern __shared__ Dtype s_shm[];
+    extern __shared__ Acc s_shm[];
 
-    Dtype* s_theta = (float*)&s_shm[0];
-    Dtype* s_bias = (float*)&s_shm[Dp * C_Din * C_Dout];
+    // theta and bias tile [Dp + 1, C_Din, C_Dout], the bias is the weight of
+    // an implicit position slot Dp that is constant one
+    Acc* s_theta = &s_shm[0];
+    Acc* s_bias = &s_shm[Dp * C_Din * C_Dout];
+    // staged neighbor features [C_Din, C_Window]
+    Acc* s_feat = &s_shm[(Dp + 1) * C_Din * C_Dout];
 
     // glob ids
     int b = blockIdx.z;
     int n = blockIdx.x * C_N + threadIdx.x;
 
-    Dtype result[C_Dout];
+    Acc result[C_Dout];
     for (int dout = 0; dout < C_Dout; ++dout) {
       result[dout] = 0.0;
     }
 
-    Dtype p0[Dp];
-#pragma unroll pmin(Dp, PMIN)
-    for (int dp = 0; dp < Dp && n < N; ++dp) {
-      p0[dp] = d_positions[b * Dp * N + dp * N + n];
-    }
+    // replace the gather of neighbors by coalesced loads of their range
+    int lo = 0;
+    bool staged = false;
+    if (Sorted) staged = neighbor_window(b, n, &lo);
 
     for (int o_din = 0; o_din < Din; o_din += C_Din) {
       // load shm
@@ -90,63 +195,94 @@ struct ForwardKernel {
 
         if (g_dout < Dout && g_din < Din) {
           s_theta[dp * C_Din * C_Dout + din * C_Dout + dout] =
-              d_theta[dp * Din * Dout + g_din * Dout + g_dout];
+              theta(dp * Din * Dout + g_din * Dout + g_dout, g_dout);
 
-          if (!dp) s_bias[din * C_Dout + dout] = d_bias[g_din * Dout + g_dout];
+          if (!dp)
+            s_bias[din * C_Dout + dout] =
+                static_cast<Acc>(d_bias[g_din * Dout + g_dout]);
+        }
+      }
+
+      if (staged) {
+        for (int tid = threadIdx.x; tid < C_Din * C_Window; tid += C_N) {
+          // consecutive threads read consecutive addresses in both layouts
+          const int din = FeaturesNWC ? tid % C_Din : tid / C_Window;
+          const int w = FeaturesNWC ? tid / C_Din : tid % C_Window;
+          if (o_din + din < Din && lo + w < N)
+            s_feat[din * C_Window + w] = feature(b, o_din + din, lo + w);
         }
       }
       __syncthreads();
 
       if (n < N) {
-        // Loop over K
-        for (int k = 0; k < K && n < N; ++k) {
-          NBtype nk = d_neighborhood[b * K * N + k * N + n];
-
-          Dtype q[Dp];
-#pragma unroll pmin(Dp, PMIN)
-          for (int dp = 0; dp < Dp; ++dp) {
-            q[dp] = d_positions[b * Dp * N + dp * N + nk] - p0[dp];
+        // The dynamic weight is linear in the relative position, hence
+        //   sum_k (bias + q_k * theta) * f_k = bias * sum_k f_k
+        //                                     + theta * sum_k q_k * f_k.
+        // Reducing over K first costs (Dp + 1) FMAs per neighbor and channel
+        // instead of (Dp + 1) * C_Dout.
+        // Loop over Din
+        for (int din = 0; din < C_Din && (o_din + din) < Din; ++din) {
+          // a[0..Dp-1]: sum_k q_k * f_k, a[Dp]: sum_k f_k (bias slot)
+          Acc a[Dp + 1];
+#pragma unroll
+          for (int dp = 0; dp <= Dp; ++dp) a[dp] = 0.0;
+
+          // Loop over K
+          for (int k = 0; k < K; ++k) {
+            NBtype nk = d_neighborhood[b * K * N + k * N + n];
+
+            Acc fk = staged ? s_feat[din * C_Window + nk - lo]
+                            : feature(b, o_din + din, nk);
+
+#pragma unroll
+            for (int dp = 0; dp < Dp; ++dp)
+              a[dp] += rel_position(b, dp, k, n) * fk;
+            a[Dp] += fk;
           }
 
-          // Loop over Din
-          for (int din = 0; din < C_Din && (o_din + din) < Din; ++din) {
-            Dtype fk = d_features[b * Din * N + (o_din + din) * N + nk];
-
-            // Loop over partial Dout
-            for (int dout = 0;
-                 dout < C_Dout && (dout + blockIdx.y * C_Dout) < Dout; ++dout) {
-              Dtype w = 0.0;
-
-              for (int dp = 0; dp < Dp; ++dp)
-                w += q[dp] * s_theta[dp * C_Din * C_Dout + din * C_Dout + dout];
-              w += s_bias[din * C_Dout + dout];
-              result[dout] += w * fk;
-            }
+          // Loop over partial Dout
+          for (int dout = 0;
+               dout < C_Dout && (dout + blockIdx.y * C_Dout) < Dout; ++dout) {
+            Acc w = 0.0;
+#pragma unroll
+            for (int dp = 0; dp <= Dp; ++dp)
+              w += a[dp] * s_theta[dp * C_Din * C_Dout + din * C_Dout + dout];
+            result[dout] += w;
           }
         }
       }
     }
 
+    // epilogue: feature bias and activation while still in registers
     for (int dout = 0;
          dout < C_Dout && (dout + blockIdx.y * C_Dout) < Dout && n < N;
          ++dout) {
-      d_output[b * Dout * N + (dout + blockIdx.y * C_Dout) * N + n] =
-          result[dout];
+      const int g_dout = dout + blockIdx.y * C_Dout;
+      d_output[b * Dout * N + g_dout * N + n] = static_cast<Dtype>(
+          ::tensorflow::functor::FlexConvActivate<Acc>(
+              result[dout] + static_cast<Acc>(d_feature_bias[g_dout]),
+              activation));
     }
   }
 
-  // features:     incoming features                          [B, Din, N].
-  // position:     each datapoint in nd space                 [B, Dp, N].
+  // features:     incoming features             [B, Din, N] or [B, N, Din].
+  // rel_positions: neighbor position relative to the point     [B, Dp, K, N].
   // neighborhood: all K nearest neighbors                	[B, K, N].
   const Dtype* d_features;
-  const Dtype* d_positions;
+  const Acc* d_rel_positions;
   const NBtype* d_neighborhood;
 
   // theta:		parameters for kernel function             	[Dp,
   // Din, Dout]. bias:       	parameters for kernel function [Din, Dout].
-  const Dtype* d_theta;
+  const Ttheta* d_theta;
   const Dtype* d_bias;
 
+  // theta_scale:  per output channel scale of quantized theta  [Dout].
+  const Dtype* d_theta_scale;
+
+  // feature_bias: bias added to the output features           [Dout].
+  const Dtype* d_feature_bias;
+
   // output:       each feature description for each point   	[B, Dout, N].
   Dtype* d_output;
 
@@ -154,6 +290,7 @@ struct ForwardKernel {
   int K;
   int Din;
   int Dout;
+  int activation;
 };
 
 template <typename Dtype>
@@ -166,7 +303,8 @@ __global__ void runBackwardKernel(const BackwardThetaKernel<T> kernel) {
 
 template <typename Dtype>
 struct BackwardThetaKernel {
-  enum { C_N = 256, DP_MAX = 3, DEGREE_MAX = 2 };
+  // DP_MAX matches the position dimensions of the forward dispatch
+  enum { C_N = 256, DP_MAX = 4, DEGREE_MAX = 2 };
 
   void launch() {
     dim3 block(C_N);
@@ -384,35 +522,136 @@ struct BackwardFeatureKernel {
 namespace tensorflow {
 namespace functor {
 
+namespace {
+
+template <typename Dtype, typename Ttheta, int Dp, bool FeaturesNWC,
+          bool Sorted>
+void LaunchForward(const Tensor& features, const Tensor& theta,
+                   const Tensor* theta_scale, const Tensor& bias,
+                   const Tensor& neighborhood, const Tensor& rel_positions,
+                   const Tensor& feature_bias,
+                   const FlexConvOptions& options, Tensor* output) {
+  typedef int NBtype;
+  typedef typename FlexConvAccumulator<Dtype>::type Acc;
+
+  const int B = neighborhood.dim_size(0);
+  const int K = neighborhood.dim_size(1);
+  const int N = neighborhood.dim_size(2);
+  const int Din = theta.dim_size(2);
+  const int Dout = theta.dim_size(3);
+
+  // staging the neighbor range needs a smaller Din tile in shared memory
+  FlexConvCuda::ForwardKernel<Dtype, NBtype, Dp, 128, 32, Sorted ? 8 : 64,
+                              FeaturesNWC, Sorted, Ttheta>
+      fwk;
+  fwk.N = N;
+  fwk.K = K;
+  fwk.Din = Din;
+  fwk.Dout = Dout;
+  fwk.activation = options.activation;
+
+  fwk.d_features = features.flat<Dtype>().data();
+  fwk.d_rel_positions = rel_positions.flat<Acc>().data();
+  fwk.d_neighborhood = neighborhood.flat<NBtype>().data();
+  fwk.d_theta = theta.flat<Ttheta>().data();
+  fwk.d_theta_scale =
+      theta_scale ? theta_scale->flat<Dtype>().data() : nullptr;
+  fwk.d_bias = bias.flat<Dtype>().data();
+  fwk.d_feature_bias = feature_bias.flat<Dtype>().data();
+  fwk.d_output = output->flat<Dtype>().data();
+
+  fwk.launch(B);
+}
+
+// Computes the relative positions of all neighbors once and dispatches to
+// the forward kernel specialized for the layout options.
+template <typename Dtype, typename Ttheta, int Dp>
+Status LaunchForward(::tensorflow::OpKernelContext* ctx,
+                     const Tensor& features, const Tensor& theta,
+                     const Tensor* theta_scale, const Tensor& bias,
+                     const Tensor& neighborhood, const Tensor& positions,
+                     const Tensor& feature_bias,
+                     const FlexConvOptions& options, Tensor* output) {
+  typedef int NBtype;
+  typedef typename FlexConvAccumulator<Dtype>::type Acc;
+
+  const int B = neighborhood.dim_size(0);
+  const int K = neighborhood.dim_size(1);
+  const int N = neighborhood.dim_size(2);
+
+  Tensor rel_positions;
+  TF_RETURN_IF_ERROR(ctx->allocate_temp(DataTypeToEnum<Acc>::value,
+                                        TensorShape({B, Dp, K, N}),
+                                        &rel_positions));
+
+  const int threads = 256;
+  dim3 grid((N - 1) / threads + 1, K, B);
+  FlexConvCuda::RelPositionsKernel<Dtype, NBtype, Dp><<<grid, threads>>>(
+      positions.flat<Dtype>().data(), neighborhood.flat<NBtype>().data(), K,
+      N, rel_positions.flat<Acc>().data());
+
+  if (options.features_nwc && options.neighborhood_sorted) {
+    LaunchForward<Dtype, Ttheta, Dp, true, true>(
+        features, theta, theta_scale, bias, neighborhood, rel_positions,
+        feature_bias, options, output);
+  } else if (options.features_nwc) {
+    LaunchForward<Dtype, Ttheta, Dp, true, false>(
+        features, theta, theta_scale, bias, neighborhood, rel_positions,
+        feature_bias, options, output);
+  } else if (options.neighborhood_sorted) {
+    LaunchForward<Dtype, Ttheta, Dp, false, true>(
+        features, theta, theta_scale, bias, neighborhood, rel_positions,
+        feature_bias, options, output);
+  } else {
+    LaunchForward<Dtype, Ttheta, Dp, false, false>(
+        features, theta, theta_scale, bias, neighborhood, rel_positions,
+        feature_bias, options, output);
+  }
+  return Status::OK();
+}
+
+// The position dimension is a template parameter, such that the loops over
+// Dp are fully unrolled and the relative position and the neighbor moments
+// stay in registers.
+template <typename Dtype, typename Ttheta>
+Status LaunchForward(::tensorflow::OpKernelContext* ctx,
+                     const Tensor& features, const Tensor& theta,
+                     const Tensor* theta_scale, const Tensor& bias,
+                     const Tensor& neighborhood, const Tensor& positions,
+                     const Tensor& feature_bias,
+                     const FlexConvOptions& options, Tensor* output) {
+  switch (theta.dim_size(1)) {
+    case 2:
+      return LaunchForward<Dtype, Ttheta, 2>(
+          ctx, features, theta, theta_scale, bias, neighborhood, positions,
+          feature_bias, options, output);
+    case 3:
+      return LaunchForward<Dtype, Ttheta, 3>(
+          ctx, features, theta, theta_scale, bias, neighborhood, positions,
+          feature_bias, options, output);
+    case 4:
+      return LaunchForward<Dtype, Ttheta, 4>(
+          ctx, features, theta, theta_scale, bias, neighborhood, positions,
+          feature_bias, options, output);
+    default:
+      return tensorflow::errors::Unimplemented(
+          "FlexConv on GPU supports positions with 2, 3 or 4 dimensions, "
+          "got ", theta.dim_size(1));
+  }
+}
+
+}  // namespace
+
 template <typename Dtype>
 struct FlexConvFunctor<GPUDevice, Dtype> {
   void operator()(::tensorflow::OpKernelContext* ctx, const Tensor& features,
                   const Tensor& theta, const Tensor& bias,
                   const Tensor& neighborhood, const Tensor& positions,
+                  const Tensor& feature_bias, const FlexConvOptions& options,
                   Tensor* output) {
-    typedef int NBtype;
-
-    const int B = neighborhood.dim_size(0);
-    const int K = neighborhood.dim_size(1);
-    const int N = neighborhood.dim_size(2);
-    const int Dp = theta.dim_size(1);
-    const int Din = theta.dim_size(2);
-    const int Dout = theta.dim_size(3);
-
-    FlexConvCuda::ForwardKernel<Dtype, NBtype, 3, 128, 32, 64> fwk;
-    fwk.N = N;
-    fwk.K = K;
-    fwk.Din = Din;
-    fwk.Dout = Dout;
-
-    fwk.d_features = features.flat<Dtype>().data();
-    fwk.d_positions = positions.flat<Dtype>().data();
-    fwk.d_neighborhood = neighborhood.flat<NBtype>().data();
-    fwk.d_theta = theta.flat<Dtype>().data();
-    fwk.d_bias = bias.flat<Dtype>().data();
-    fwk.d_output = output->flat<Dtype>().data();
-
-    fwk.launch(B);
+    OP_REQUIRES_OK(ctx, LaunchForward<Dtype, Dtype>(
+                            ctx, features, theta, nullptr, bias, neighborhood,
+                            positions, feature_bias, options, output));
 
     if (!ctx->eigen_gpu_device().ok()) {
       ctx->SetStatus(tensorflow::errors::Internal(
@@ -422,6 +661,28 @@ struct FlexConvFunctor<GPUDevice, Dtype> {
 };
 
 template struct FlexConvFunctor<GPUDevice, float>;
+template struct FlexConvFunctor<GPUDevice, bfloat16>;
+
+template <typename Dtype>
+struct FlexConvQuantizedFunctor<GPUDevice, Dtype> {
+  void operator()(::tensorflow::OpKernelContext* ctx, const Tensor& features,
+                  const Tensor& theta, const Tensor& theta_scale,
+                  const Tensor& bias, const Tensor& neighborhood,
+                  const Tensor& positions, const Tensor& feature_bias,
+                  const FlexConvOptions& options, Tensor* output) {
+    OP_REQUIRES_OK(ctx, LaunchForward<Dtype, int8>(
+                            ctx, features, theta, &theta_scale, bias,
+                            neighborhood, positions, feature_bias, options,
+                            output));
+
+    if (!ctx->eigen_gpu_device().ok()) {
+      ctx->SetStatus(tensorflow::errors::Internal(
+          "FlexConvQuantizedFunctor::forward::ForwardKernel execution failed"));
+    }
+  }
+};
+
+template struct FlexConvQuantizedFunctor<GPUDevice, float>;
 
 template <typename Dtype>
 struct FlexConvGrad<GPUDevice, Dtype> {
@@ -449,6 +710,12 @@ struct FlexConvGrad<GPUDevice, Dtype> {
     const int Din = theta_.dim_size(2);
     const int Dout = theta_.dim_size(3);
 
+    const int Dp_max = FlexConvCuda::BackwardThetaKernel<Dtype>::DP_MAX;
+    OP_REQUIRES(ctx, Dp <= Dp_max,
+                tensorflow::errors::Unimplemented(
+                    "FlexConvGrad on GPU supports positions with up to ",
+                    Dp_max, " dimensions, got ", Dp));
+
     const int* neighborhood_ptr =
         reinterpret_cast<const int*>(neighborhood.data());
     const Dtype* positions_ptr =
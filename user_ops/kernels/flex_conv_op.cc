@@ -25,12 +25,87 @@ limitations under the License.
 
 namespace tensorflow {
 
+namespace {
+
+// parse the attributes shared by all forward ops
+Status GetFlexConvOptions(OpKernelConstruction* ctx,
+                          functor::FlexConvOptions* options) {
+  string activation;
+  TF_RETURN_IF_ERROR(ctx->GetAttr("activation", &activation));
+  if (activation == "relu") {
+    options->activation = functor::kFlexConvRelu;
+  } else if (activation == "elu") {
+    options->activation = functor::kFlexConvElu;
+  } else if (activation == "sigmoid") {
+    options->activation = functor::kFlexConvSigmoid;
+  } else {
+    options->activation = functor::kFlexConvNone;
+  }
+
+  string data_format;
+  TF_RETURN_IF_ERROR(ctx->GetAttr("data_format", &data_format));
+  options->features_nwc = (data_format == "NWC");
+
+  TF_RETURN_IF_ERROR(
+      ctx->GetAttr("neighborhood_sorted", &options->neighborhood_sorted));
+
+  TF_RETURN_IF_ERROR(ctx->GetAttr("Din", &options->din));
+  TF_RETURN_IF_ERROR(ctx->GetAttr("Dout", &options->dout));
+  TF_RETURN_IF_ERROR(ctx->GetAttr("K", &options->k));
+  TF_RETURN_IF_ERROR(ctx->GetAttr("Dp", &options->dp));
+  return Status::OK();
+}
+
+// The inputs must match the dimensions fixed when building the graph and the
+// weights. Din and Dp are read from the features and positions, as the
+// kernels index them with the dimensions of theta.
+Status CheckFlexConvDims(const functor::FlexConvOptions& options,
+                         const Tensor& features, const Tensor& theta,
+                         const Tensor& bias, const Tensor& neighborhood,
+                         const Tensor& positions) {
+  const int din_axis = options.features_nwc ? 2 : 1;
+  const int64 Din = features.dim_size(din_axis);
+  const int64 Dp = positions.dim_size(1);
+
+  const struct {
+    const char* name;
+    int expected;
+    int64 actual;
+  } dims[] = {{"Din", options.din, Din},
+              {"Dout", options.dout, theta.dim_size(3)},
+              {"K", options.k, neighborhood.dim_size(1)},
+              {"Dp", options.dp, Dp}};
+
+  for (const auto& dim : dims) {
+    if (dim.expected >= 0 && dim.expected != dim.actual) {
+      return errors::InvalidArgument("FlexConv was built for ", dim.name,
+                                     " = ", dim.expected, " but got ",
+                                     dim.actual);
+    }
+  }
+
+  if (theta.dim_size(2) != Din || bias.dim_size(0) != Din) {
+    return errors::InvalidArgument(
+        "FlexConv got features with Din = ", Din, " but theta and bias for ",
+        theta.dim_size(2), " and ", bias.dim_size(0));
+  }
+  if (theta.dim_size(1) != Dp) {
+    return errors::InvalidArgument("FlexConv got positions with Dp = ", Dp,
+                                   " but theta for ", theta.dim_size(1));
+  }
+  return Status::OK();
+}
+
+}  // namespace
+
 // Forward-Pass (CPU, GPU)
 // --------------------------------------------------
 template <typename Device, typename Dtype>
 class FlexConvOp : public OpKernel {
  public:
-  explicit FlexConvOp(OpKernelConstruction* ctx) : OpKernel(ctx) {}
+  explicit FlexConvOp(OpKernelConstruction* ctx) : OpKernel(ctx) {
+    OP_REQUIRES_OK(ctx, GetFlexConvOptions(ctx, &options_));
+  }
 
   void Compute(OpKernelContext* ctx) override {
     // printf("--> Compute CPU Version <--\n");
@@ -39,6 +114,10 @@ class FlexConvOp : public OpKernel {
     const Tensor& bias_ = ctx->input(2);
     const Tensor& neighborhood_ = ctx->input(3);
     const Tensor& positions_ = ctx->input(4);
+    const Tensor& feature_bias_ = ctx->input(5);
+
+    OP_REQUIRES_OK(ctx, CheckFlexConvDims(options_, features_, theta_, bias_,
+                                          neighborhood_, positions_));
 
     const int B = neighborhood_.shape().dim_size(0);
     const int N = neighborhood_.shape().dim_size(2);
@@ -49,13 +128,56 @@ class FlexConvOp : public OpKernel {
         ctx, ctx->allocate_output(0, TensorShape({B, Dout, N}), &output_));
 
     ::tensorflow::functor::FlexConvFunctor<Device, Dtype>()(
-        ctx, features_, theta_, bias_, neighborhood_, positions_, output_);
+        ctx, features_, theta_, bias_, neighborhood_, positions_,
+        feature_bias_, options_, output_);
   }
 
  private:
+  functor::FlexConvOptions options_;
+
   TF_DISALLOW_COPY_AND_ASSIGN(FlexConvOp);
 };
 
+// Forward-Pass with int8 theta (CPU, GPU)
+// --------------------------------------------------
+template <typename Device, typename Dtype>
+class FlexConvInt8Op : public OpKernel {
+ public:
+  explicit FlexConvInt8Op(OpKernelConstruction* ctx) : OpKernel(ctx) {
+    OP_REQUIRES_OK(ctx, GetFlexConvOptions(ctx, &options_));
+  }
+
+  void Compute(OpKernelContext* ctx) override {
+    const Tensor& features_ = ctx->input(0);
+    const Tensor& theta_ = ctx->input(1);
+    const Tensor& bias_ = ctx->input(2);
+    const Tensor& neighborhood_ = ctx->input(3);
+    const Tensor& positions_ = ctx->input(4);
+    const Tensor& feature_bias_ = ctx->input(5);
+    const Tensor& theta_scale_ = ctx->input(6);
+
+    OP_REQUIRES_OK(ctx, CheckFlexConvDims(options_, features_, theta_, bias_,
+                                          neighborhood_, positions_));
+
+    const int B = neighborhood_.shape().dim_size(0);
+    const int N = neighborhood_.shape().dim_size(2);
+    const int Dout = theta_.shape().dim_size(3);
+
+    Tensor* output_ = nullptr;
+    OP_REQUIRES_OK(
+        ctx, ctx->allocate_output(0, TensorShape({B, Dout, N}), &output_));
+
+    ::tensorflow::functor::FlexConvQuantizedFunctor<Device, Dtype>()(
+        ctx, features_, theta_, theta_scale_, bias_, neighborhood_,
+        positions_, feature_bias_, options_, output_);
+  }
+
+ private:
+  functor::FlexConvOptions options_;
+
+  TF_DISALLOW_COPY_AND_ASSIGN(FlexConvInt8Op);
+};
+
 // Backward-Pass (CPU, GPU)
 // --------------------------------------------------
 template <typename Device, typename Dtype>
@@ -96,6 +218,9 @@ class FlexConvGradOp : public OpKernel {
   REGISTER_KERNEL_BUILDER(                                            \
       Name("FlexConv").Device(DEVICE_CPU).TypeConstraint<T>("T"),     \
       FlexConvOp<CPUDevice, T>)                                       \
+  REGISTER_KERNEL_BUILDER(                                            \
+      Name("FlexConvInt8").Device(DEVICE_CPU).TypeConstraint<T>("T"), \
+      FlexConvInt8Op<CPUDevice, T>)                                   \
   REGISTER_KERNEL_BUILDER(                                            \
       Name("FlexConvGrad").Device(DEVICE_CPU).TypeConstraint<T>("T"), \
       FlexConvGradOp<CPUDevice, T>)
@@ -103,6 +228,11 @@ class FlexConvGradOp : public OpKernel {
 TF_CALL_float(REGISTER_FLEXCONV_OP_CPU);
 #undef REGISTER_FLEXCONV_OP_CPU
 
+// bfloat16 is forward only, the gradient runs in float (see __init__.py)
+REGISTER_KERNEL_BUILDER(
+    Name("FlexConv").Device(DEVICE_CPU).TypeConstraint<bfloat16>("T"),
+    FlexConvOp<CPUDevice, bfloat16>)
+
 // Register the GPU kernels.
 // #ifdef GOOGLE_CUDA
 
@@ -110,6 +240,9 @@ TF_CALL_float(REGISTER_FLEXCONV_OP_CPU);
   REGISTER_KERNEL_BUILDER(                                            \
       Name("FlexConv").Device(DEVICE_GPU).TypeConstraint<T>("T"),     \
       FlexConvOp<GPUDevice, T>)                                       \
+  REGISTER_KERNEL_BUILDER(                                            \
+      Name("FlexConvInt8").Device(DEVICE_GPU).TypeConstraint<T>("T"), \
+      FlexConvInt8Op<GPUDevice, T>)                                   \
   REGISTER_KERNEL_BUILDER(                                            \
       Name("FlexConvGrad").Device(DEVICE_GPU).TypeConstraint<T>("T"), \
       FlexConvGradOp<GPUDevice, T>)
@@ -117,6 +250,10 @@ TF_CALL_float(REGISTER_FLEXCONV_OP_CPU);
 TF_CALL_float(REGISTER_FLEXCONV_OP_GPU);
 #undef REGISTER_FLEXCONV_OP_GPU
 
+REGISTER_KERNEL_BUILDER(
+    Name("FlexConv").Device(DEVICE_GPU).TypeConstraint<bfloat16>("T"),
+    FlexConvOp<GPUDevice, bfloat16>)
+
 // #endif  // GOOGLE_CUDA
 
 }  // namespace tensorflow
@@ -30,14 +30,75 @@ using GPUDevice = Eigen::GpuDevice;
 namespace tensorflow {
 namespace functor {
 
+// activation applied to the accumulator before the final store
+enum FlexConvActivation {
+  kFlexConvNone = 0,
+  kFlexConvRelu = 1,
+  kFlexConvElu = 2,
+  kFlexConvSigmoid = 3
+};
+
+template <typename Dtype>
+EIGEN_DEVICE_FUNC EIGEN_STRONG_INLINE Dtype FlexConvActivate(Dtype x,
+                                                             int activation) {
+  switch (activation) {
+    case kFlexConvRelu:
+      return x > Dtype(0) ? x : Dtype(0);
+    case kFlexConvElu:
+      return x > Dtype(0) ? x : Eigen::numext::exp(x) - Dtype(1);
+    case kFlexConvSigmoid:
+      return Dtype(1) / (Dtype(1) + Eigen::numext::exp(-x));
+    default:
+      return x;
+  }
+}
+
+// type the forward kernels accumulate in, reduced precision inputs are
+// widened once when read and only the final store is narrowed again
+template <typename Dtype>
+struct FlexConvAccumulator {
+  typedef Dtype type;
+};
+
+template <>
+struct FlexConvAccumulator<bfloat16> {
+  typedef float type;
+};
+
+// options of the forward pass, parsed once from the op attributes
+struct FlexConvOptions {
+  // one of FlexConvActivation
+  int activation = kFlexConvNone;
+  // features are given as [B, N, Din] instead of [B, Din, N]
+  bool features_nwc = false;
+  // neighborhoods come from a spatially sorted point cloud
+  bool neighborhood_sorted = false;
+  // dimensions fixed when building the graph, -1 if unknown
+  int din = -1;
+  int dout = -1;
+  int k = -1;
+  int dp = -1;
+};
+
 template <typename Device, typename Dtype>
 struct FlexConvFunctor {
   void operator()(::tensorflow::OpKernelContext* ctx, const Tensor& features_,
                   const Tensor& theta_, const Tensor& bias_,
                   const Tensor& neighborhood_, const Tensor& positions_,
+                  const Tensor& feature_bias_, const FlexConvOptions& options,
                   Tensor* output_);
 };
 
+// forward pass with theta quantized to int8 and a scale per output channel
+template <typename Device, typename Dtype>
+struct FlexConvQuantizedFunctor {
+  void operator()(::tensorflow::OpKernelContext* ctx, const Tensor& features_,
+                  const Tensor& theta_, const Tensor& theta_scale_,
+                  const Tensor& bias_, const Tensor& neighborhood_,
+                  const Tensor& positions_, const Tensor& feature_bias_,
+                  const FlexConvOptions& options, Tensor* output_);
+};
+
 template <typename Device, typename Dtype>
 struct FlexConvGrad {
   void operator()(::tensorflow::OpKernelContext* ctx, const Tensor& features_,
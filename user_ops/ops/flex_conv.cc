@@ -22,81 +22,172 @@ namespace tensorflow {
 using ::tensorflow::shape_inference::InferenceContext;
 using ::tensorflow::shape_inference::ShapeHandle;
 
+// shared by the forward ops, which only differ in the dtype of theta
+Status FlexConvShapeFn(InferenceContext* c) {
+  const auto features = c->input(0);
+  const auto theta = c->input(1);
+  const auto bias = c->input(2);
+  const auto neighborhood = c->input(3);
+  const auto position = c->input(4);
+  const auto feature_bias = c->input(5);
+
+  // features are [B, Din, N] (NCW) or [B, N, Din] (NWC)
+  string data_format;
+  TF_RETURN_IF_ERROR(c->GetAttr("data_format", &data_format));
+  const int din_axis = (data_format == "NWC") ? 2 : 1;
+  const int n_axis = (data_format == "NWC") ? 1 : 2;
+
+  // we require the input to have 4 axes
+  ::tensorflow::shape_inference::ShapeHandle shape_hnd;
+  TF_RETURN_IF_ERROR(c->WithRank(features, 3, &shape_hnd));  // B x Din x Ng
+  TF_RETURN_IF_ERROR(
+      c->WithRank(theta, 4, &shape_hnd));  // 1 x Dp x Din x Dout
+  TF_RETURN_IF_ERROR(c->WithRank(bias, 2, &shape_hnd));  // Din x Dout
+  TF_RETURN_IF_ERROR(
+      c->WithRank(neighborhood, 3, &shape_hnd));             // B x K x N
+  TF_RETURN_IF_ERROR(c->WithRank(position, 3, &shape_hnd));  // B x Dp x Ng
+  TF_RETURN_IF_ERROR(c->WithRank(feature_bias, 1, &shape_hnd));  // Dout
+
+  shape_inference::DimensionHandle merged;
+
+  // assert B equal
+  TF_RETURN_IF_ERROR(
+      c->Merge(c->Dim(features, 0), c->Dim(neighborhood, 0), &merged));
+  TF_RETURN_IF_ERROR(
+      c->Merge(c->Dim(features, 0), c->Dim(position, 0), &merged));
+
+  // assert Ng equal
+  TF_RETURN_IF_ERROR(
+      c->Merge(c->Dim(features, n_axis), c->Dim(neighborhood, 2),
+               &merged));  // TODO(fabi?) fix global access and remove
+  TF_RETURN_IF_ERROR(
+      c->Merge(c->Dim(features, n_axis), c->Dim(position, 2), &merged));
+
+  // assert Dp equal
+  TF_RETURN_IF_ERROR(
+      c->Merge(c->Dim(theta, 1), c->Dim(position, 1), &merged));
+
+  // assert Dout equal
+  TF_RETURN_IF_ERROR(c->Merge(c->Dim(theta, 3), c->Dim(bias, 1), &merged));
+  TF_RETURN_IF_ERROR(
+      c->Merge(c->Dim(theta, 3), c->Dim(feature_bias, 0), &merged));
+
+  // assert Din equal
+  TF_RETURN_IF_ERROR(
+      c->Merge(c->Dim(features, din_axis), c->Dim(theta, 2), &merged));
+  TF_RETURN_IF_ERROR(
+      c->Merge(c->Dim(features, din_axis), c->Dim(bias, 0), &merged));
+
+  // dimensions known when building the graph, -1 if not given
+  int din, dout, k, dp;
+  TF_RETURN_IF_ERROR(c->GetAttr("Din", &din));
+  TF_RETURN_IF_ERROR(c->GetAttr("Dout", &dout));
+  TF_RETURN_IF_ERROR(c->GetAttr("K", &k));
+  TF_RETURN_IF_ERROR(c->GetAttr("Dp", &dp));
+
+  auto Din = c->Dim(theta, 2);
+  auto Dout = c->Dim(bias, 1);
+  if (din >= 0) TF_RETURN_IF_ERROR(c->Merge(Din, c->MakeDim(din), &Din));
+  if (dout >= 0) TF_RETURN_IF_ERROR(c->Merge(Dout, c->MakeDim(dout), &Dout));
+  if (k >= 0)
+    TF_RETURN_IF_ERROR(
+        c->Merge(c->Dim(neighborhood, 1), c->MakeDim(k), &merged));
+  if (dp >= 0)
+    TF_RETURN_IF_ERROR(c->Merge(c->Dim(theta, 1), c->MakeDim(dp), &merged));
+
+  // specify output-shape
+  auto B = c->Dim(features, 0);
+  auto N = c->Dim(neighborhood, 2);
+  c->set_output(0, c->MakeShape({B, Dout, N}));
+
+  return Status::OK();
+}
+
 REGISTER_OP("FlexConv")
     .Input("features: T")
     .Input("theta: T")
     .Input("bias: T")
     .Input("neighborhood: int32")
     .Input("position: T")
+    .Input("feature_bias: T")
     .Output("output: T")
     .Attr("T: realnumbertype")
-    .SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c) {
-      const auto features = c->input(0);
-      const auto theta = c->input(1);
-      const auto bias = c->input(2);
-      const auto neighborhood = c->input(3);
-      const auto position = c->input(4);
-
-      // we require the input to have 4 axes
-      ::tensorflow::shape_inference::ShapeHandle shape_hnd;
-      TF_RETURN_IF_ERROR(c->WithRank(features, 3, &shape_hnd));  // B x Din x Ng
-      TF_RETURN_IF_ERROR(
-          c->WithRank(theta, 4, &shape_hnd));  // 1 x Dp x Din x Dout
-      TF_RETURN_IF_ERROR(c->WithRank(bias, 2, &shape_hnd));  // Din x Dout
-      TF_RETURN_IF_ERROR(
-          c->WithRank(neighborhood, 3, &shape_hnd));             // B x K x N
-      TF_RETURN_IF_ERROR(c->WithRank(position, 3, &shape_hnd));  // B x Dp x Ng
-
-      shape_inference::DimensionHandle merged;
-
-      // assert B equal
-      TF_RETURN_IF_ERROR(
-          c->Merge(c->Dim(features, 0), c->Dim(neighborhood, 0), &merged));
-      TF_RETURN_IF_ERROR(
-          c->Merge(c->Dim(features, 0), c->Dim(position, 0), &merged));
-
-      // assert Ng equal
-      TF_RETURN_IF_ERROR(
-          c->Merge(c->Dim(features, 2), c->Dim(neighborhood, 2),
-                   &merged));  // TODO(fabi?) fix global access and remove
-      TF_RETURN_IF_ERROR(
-          c->Merge(c->Dim(features, 2), c->Dim(position, 2), &merged));
-
-      // assert Dp equal
-      TF_RETURN_IF_ERROR(
-          c->Merge(c->Dim(theta, 1), c->Dim(position, 1), &merged));
-
-      // assert Dout equal
-      TF_RETURN_IF_ERROR(c->Merge(c->Dim(theta, 3), c->Dim(bias, 1), &merged));
-
-      // assert Din equal
-      TF_RETURN_IF_ERROR(
-          c->Merge(c->Dim(features, 1), c->Dim(theta, 2), &merged));
-      TF_RETURN_IF_ERROR(
-          c->Merge(c->Dim(features, 1), c->Dim(bias, 0), &merged));
-
-      // specify output-shape
-      auto B = c->Dim(features, 0);
-      auto Dout = c->Dim(bias, 1);
-      auto N = c->Dim(neighborhood, 2);
-      c->set_output(0, c->MakeShape({B, Dout, N}));
-
-      return Status::OK();
-    })
+    .Attr("activation: {'none', 'relu', 'elu', 'sigmoid'} = 'none'")
+    .Attr("data_format: {'NCW', 'NWC'} = 'NCW'")
+    .Attr("neighborhood_sorted: bool = false")
+    .Attr("Din: int = -1")
+    .Attr("Dout: int = -1")
+    .Attr("K: int = -1")
+    .Attr("Dp: int = -1")
+    .SetShapeFn(FlexConvShapeFn)
     .Doc(R"doc(
 Apply Sparse Convolution to inputs.
 
 This applies a convolution to a neighborhood of inputs. The formula for computing the output is as follows:
 
-  `output_j = \sum_i w(x_i, x0) * x_i`
+  `output_j = act(\sum_i w(x_i, x0) * x_i + feature_bias)`
   `w(x_i, x0) = ??`
 
-features: each feature description for each point [B, Din, N].
+The feature bias and the activation are applied to the accumulator before
+the result is written, which avoids extra passes over the output.
+
+features: each feature description for each point [B, Din, N] or [B, N, Din].
 theta: parameters for kernel function [1, Dp, Din, Dout].
 bias: bias for kernel function [Din, Dout].
 neighborhood: all K nearest neighbors [B, K, N].
 position: each datapoint in 3d space [B, Dp, N].
+feature_bias: bias added to the output features [Dout].
 output: each feature description for each point [B, Dout, N].
+activation: activation applied to the output features.
+data_format: layout of the features, 'NWC' keeps the channels of each point
+  contiguous which speeds up gathering the neighbors.
+neighborhood_sorted: whether the points are spatially sorted (e.g. Morton
+  order), such that neighbors of consecutive points lie in a small range.
+  The GPU kernel then loads this range coalesced instead of gathering.
+Din: number of input features if known when building the graph, otherwise -1.
+Dout: number of output features if known, otherwise -1.
+K: number of neighbors if known, otherwise -1.
+Dp: dimension of the positions if known, otherwise -1.
+)doc");
+
+REGISTER_OP("FlexConvInt8")
+    .Input("features: T")
+    .Input("theta: int8")
+    .Input("bias: T")
+    .Input("neighborhood: int32")
+    .Input("position: T")
+    .Input("feature_bias: T")
+    .Input("theta_scale: T")
+    .Output("output: T")
+    .Attr("T: realnumbertype")
+    .Attr("activation: {'none', 'relu', 'elu', 'sigmoid'} = 'none'")
+    .Attr("data_format: {'NCW', 'NWC'} = 'NCW'")
+    .Attr("neighborhood_sorted: bool = false")
+    .Attr("Din: int = -1")
+    .Attr("Dout: int = -1")
+    .Attr("K: int = -1")
+    .Attr("Dp: int = -1")
+    .SetShapeFn([](InferenceContext* c) {
+      TF_RETURN_IF_ERROR(FlexConvShapeFn(c));
+
+      ShapeHandle shape_hnd;
+      TF_RETURN_IF_ERROR(c->WithRank(c->input(6), 1, &shape_hnd));  // Dout
+
+      // assert Dout equal
+      shape_inference::DimensionHandle merged;
+      TF_RETURN_IF_ERROR(
+          c->Merge(c->Dim(c->input(1), 3), c->Dim(c->input(6), 0), &merged));
+      return Status::OK();
+    })
+    .Doc(R"doc(
+Apply Sparse Convolution to inputs using an int8 quantized theta.
+
+Inference-only variant of FlexConv. Theta is stored as int8 and dequantized
+with a scale per output channel, `theta_scale[dout] * theta[..., dout]`, when
+the kernel loads it. This reduces the bytes of theta read by each block by 4x.
+
+theta: quantized parameters for kernel function [1, Dp, Din, Dout].
+theta_scale: scale of each output channel of theta [Dout].
 )doc");
 
 REGISTER_OP("FlexConvGrad")
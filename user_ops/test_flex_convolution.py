@@ -19,9 +19,13 @@
 
 
 from PointTestCase import TPC, PointTestCase, summary
+import numpy as np
 import tensorflow as tf
 
-from __init__ import flex_convolution
+from __init__ import flex_convolution, flex_convolution_int8
+from layers_gather import flex_gather, flex_convolution_from_gathered
+from layers_gather import quantize_theta
+import layers_fallback
 
 
 class FlexConvTest(PointTestCase):
@@ -42,6 +46,31 @@ class FlexConvTest(PointTestCase):
     gpu = self._forward(use_gpu=True)
     self.assertAllClose(cpu, gpu, 1e-5, 1e-5)
 
+  def _forward_fused(self, activation, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+      actual_op = flex_convolution(self.features_op,
+                                   self.position_op, self.neighborhood_op,
+                                   self.theta_op, self.bias_op,
+                                   feature_bias=self.feature_bias_op,
+                                   activation=activation)
+      actual = sess.run(actual_op)
+    return actual
+
+  def test_forward_fused(self):
+    plain = self._forward(use_gpu=False)
+    plain = plain + self.feature_bias.reshape([1, -1, 1])
+    expected = {'none': plain,
+                'relu': np.maximum(plain, 0),
+                'elu': np.where(plain > 0, plain, np.exp(plain) - 1),
+                'sigmoid': 1. / (1. + np.exp(-plain))}
+
+    for activation, expected_value in expected.items():
+      cpu = self._forward_fused(activation, use_gpu=False)
+      gpu = self._forward_fused(activation, use_gpu=True)
+      self.assertAllClose(expected_value, cpu, 1e-5, 1e-5)
+      self.assertAllClose(cpu, gpu, 1e-5, 1e-5)
+
   def _backward_features(self, use_gpu=False):
     self.init_ops()
     with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu):
@@ -92,6 +121,199 @@ class FlexConvTest(PointTestCase):
                                            TPC.expected_output_shape())
       self.assertLess(err, 1e-2)
 
+  def _forward_nwc(self, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+      actual_op = flex_convolution(tf.transpose(self.features_op, [0, 2, 1]),
+                                   self.position_op, self.neighborhood_op,
+                                   self.theta_op, self.bias_op,
+                                   data_format='NWC')
+      actual = sess.run(actual_op)
+    return actual
+
+  def test_forward_nwc(self):
+    expected = self._forward(use_gpu=False)
+    cpu = self._forward_nwc(use_gpu=False)
+    gpu = self._forward_nwc(use_gpu=True)
+    self.assertAllClose(expected, cpu, 1e-5, 1e-5)
+    self.assertAllClose(cpu, gpu, 1e-5, 1e-5)
+
+  def _forward_sorted(self, data_format, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+      features_op = self.features_op
+      if data_format == 'NWC':
+        features_op = tf.transpose(features_op, [0, 2, 1])
+      actual_op = flex_convolution(features_op,
+                                   self.position_op, self.neighborhood_op,
+                                   self.theta_op, self.bias_op,
+                                   data_format=data_format,
+                                   neighborhood_sorted=True)
+      actual = sess.run(actual_op)
+    return actual
+
+  def test_forward_sorted(self):
+    # the test cloud is small enough for the neighbors of each block to fit
+    # into the staging buffer, hence this exercises the staged path
+    expected = self._forward(use_gpu=False)
+    for data_format in ['NCW', 'NWC']:
+      cpu = self._forward_sorted(data_format, use_gpu=False)
+      gpu = self._forward_sorted(data_format, use_gpu=True)
+      self.assertAllClose(expected, cpu, 1e-5, 1e-5)
+      self.assertAllClose(cpu, gpu, 1e-5, 1e-5)
+
+  def _forward_from_gathered(self, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+      actual_op = flex_convolution_from_gathered(
+          flex_gather(self.features_op, self.neighborhood_op),
+          flex_gather(self.position_op, self.neighborhood_op),
+          self.theta_op, self.bias_op,
+          feature_bias=self.feature_bias_op, activation='elu')
+      actual = sess.run(actual_op)
+    return actual
+
+  def test_forward_from_gathered(self):
+    expected = self._forward_fused('elu', use_gpu=False)
+    cpu = self._forward_from_gathered(use_gpu=False)
+    gpu = self._forward_from_gathered(use_gpu=True)
+    self.assertAllClose(expected, cpu, 1e-5, 1e-5)
+    self.assertAllClose(cpu, gpu, 1e-5, 1e-5)
+
+  def _forward_fallback(self, data_format):
+    self.init_ops()
+    with self.test_session(use_gpu=False) as sess:
+      features_op = self.features_op
+      if data_format == 'NWC':
+        features_op = tf.transpose(features_op, [0, 2, 1])
+      actual_op = layers_fallback.flex_convolution(
+          features_op, self.position_op, self.neighborhood_op,
+          self.theta_op, self.bias_op,
+          feature_bias=self.feature_bias_op, activation='elu',
+          data_format=data_format)
+      actual = sess.run(actual_op)
+    return actual
+
+  def test_forward_fallback(self):
+    expected = self._forward_fused('elu', use_gpu=False)
+    for data_format in ['NCW', 'NWC']:
+      actual = self._forward_fallback(data_format)
+      self.assertAllClose(expected, actual, 1e-5, 1e-5)
+
+  def _forward_dims_mismatch(self, dims, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+      # the static shape of the features is unknown, only the kernel can
+      # catch that they have one channel more than theta
+      features_op = tf.placeholder(tf.float32, [None, None, None])
+      actual_op = flex_convolution(features_op,
+                                   self.position_op, self.neighborhood_op,
+                                   self.theta_op, self.bias_op, dims=dims)
+      features = np.concatenate([self.features, self.features[:, :1]], axis=1)
+      with self.assertRaises(tf.errors.InvalidArgumentError):
+        sess.run(actual_op, {features_op: features})
+
+  def test_forward_dims_mismatch(self):
+    for dims in [None, {'Din': TPC.Din, 'Dp': TPC.Dp}]:
+      self._forward_dims_mismatch(dims, use_gpu=False)
+      self._forward_dims_mismatch(dims, use_gpu=True)
+
+  def _forward_bf16(self, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+      actual_op = flex_convolution(
+          tf.cast(self.features_op, tf.bfloat16),
+          tf.cast(self.position_op, tf.bfloat16), self.neighborhood_op,
+          tf.cast(self.theta_op, tf.bfloat16),
+          tf.cast(self.bias_op, tf.bfloat16))
+      actual = sess.run(tf.cast(actual_op, tf.float32))
+    return actual
+
+  def test_forward_bf16(self):
+    expected = self._forward(use_gpu=False)
+    cpu = self._forward_bf16(use_gpu=False)
+    gpu = self._forward_bf16(use_gpu=True)
+    # inputs and output are rounded to 8 bits of mantissa
+    self.assertAllClose(expected, cpu, 5e-2, 5e-2)
+    self.assertAllClose(cpu, gpu, 1e-2, 1e-2)
+
+  def _backward_dtype(self, dtype, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+      inputs = [self.features_op, self.theta_op, self.bias_op,
+                self.feature_bias_op]
+      features_op, theta_op, bias_op, feature_bias_op = [
+          tf.cast(x, dtype) for x in inputs]
+      actual_op = flex_convolution(features_op,
+                                   tf.cast(self.position_op, dtype),
+                                   self.neighborhood_op, theta_op, bias_op,
+                                   feature_bias=feature_bias_op,
+                                   activation='elu')
+      grads = tf.gradients(tf.cast(actual_op, tf.float32), inputs)
+      actual = sess.run(grads)
+    return actual
+
+  def test_backward_bf16(self):
+    # the fused activation is backpropagated in float32 as well
+    expected = self._backward_dtype(tf.float32, use_gpu=False)
+    cpu = self._backward_dtype(tf.bfloat16, use_gpu=False)
+    gpu = self._backward_dtype(tf.bfloat16, use_gpu=True)
+    for e, c, g in zip(expected, cpu, gpu):
+      self.assertAllClose(e, c, 5e-2, 5e-2)
+      self.assertAllClose(c, g, 1e-2, 1e-2)
+
+  def _forward_int8(self, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+      theta_op, theta_scale_op = quantize_theta(self.theta_op)
+      actual_op = flex_convolution_int8(self.features_op,
+                                        self.position_op, self.neighborhood_op,
+                                        theta_op, theta_scale_op, self.bias_op)
+      actual = sess.run(actual_op)
+    return actual
+
+  def test_forward_int8(self):
+    expected = self._forward(use_gpu=False)
+    cpu = self._forward_int8(use_gpu=False)
+    gpu = self._forward_int8(use_gpu=True)
+    # quantization error of theta is at most scale / 2 per entry
+    self.assertAllClose(expected, cpu, 1e-2, 1e-2)
+    self.assertAllClose(cpu, gpu, 1e-5, 1e-5)
+
+  def _backward_features_nwc(self, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu):
+      features_op = tf.transpose(self.features_op, [0, 2, 1])
+      actual_op = flex_convolution(features_op,
+                                   self.position_op, self.neighborhood_op,
+                                   self.theta_op, self.bias_op,
+                                   data_format='NWC')
+
+      err = tf.test.compute_gradient_error([self.features_op],
+                                           [self.features.shape],
+                                           actual_op, TPC.expected_output_shape())
+      self.assertLess(err, 1e-2)
+
+  def _backward_feature_bias(self, use_gpu=False):
+    self.init_ops()
+    with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu):
+      actual_op = flex_convolution(self.features_op,
+                                   self.position_op, self.neighborhood_op,
+                                   self.theta_op, self.bias_op,
+                                   feature_bias=self.feature_bias_op,
+                                   activation='sigmoid')
+
+      graph_grad, num_grad = tf.test.compute_gradient(
+          [self.feature_bias_op], [self.feature_bias.shape], actual_op,
+          TPC.expected_output_shape())[0]
+      summary(num_grad, graph_grad, 'self.feature_bias')
+
+      err = tf.test.compute_gradient_error([self.feature_bias_op],
+                                           [self.feature_bias.shape],
+                                           actual_op,
+                                           TPC.expected_output_shape())
+      self.assertLess(err, 1e-2)
+
   def test_backward_features(self):
     self._backward_features(use_gpu=False)
     self._backward_features(use_gpu=True)
@@ -104,6 +326,14 @@ class FlexConvTest(PointTestCase):
     self._backward_theta(use_gpu=False)
     self._backward_theta(use_gpu=True)
 
+  def test_backward_features_nwc(self):
+    self._backward_features_nwc(use_gpu=False)
+    self._backward_features_nwc(use_gpu=True)
+
+  def test_backward_feature_bias(self):
+    self._backward_feature_bias(use_gpu=False)
+    self._backward_feature_bias(use_gpu=True)
+
 
 if __name__ == '__main__':
   tf.test.main()
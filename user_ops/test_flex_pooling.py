@@ -23,6 +23,8 @@ import tensorflow as tf
 import numpy as np
 
 from __init__ import flex_pooling
+from layers_gather import flex_gather, flex_pooling_from_gathered
+import layers_fallback
 
 
 class FlexPoolTest(PointTestCase):
@@ -41,6 +43,33 @@ class FlexPoolTest(PointTestCase):
         gpu = self._forward(use_gpu=True)
         self.assertAllClose(cpu, gpu)
 
+    def _forward_from_gathered(self, use_gpu=False):
+        self.init_ops()
+        with self.test_session(use_gpu=use_gpu, force_gpu=use_gpu) as sess:
+            gathered_op = flex_gather(self.features_op, self.neighborhood_op)
+            actual_op = flex_pooling_from_gathered(gathered_op)
+            actual = sess.run(actual_op)
+        return actual
+
+    def test_forward_from_gathered(self):
+        expected = self._forward(use_gpu=False)
+        cpu = self._forward_from_gathered(use_gpu=False)
+        gpu = self._forward_from_gathered(use_gpu=True)
+        self.assertAllClose(expected, cpu)
+        self.assertAllClose(cpu, gpu)
+
+    def _forward_with_winner(self, pooling):
+        self.init_ops()
+        with self.test_session(use_gpu=False) as sess:
+            actual_op, winner_op = pooling(self.features_op, self.neighborhood_op)
+            return sess.run([actual_op, winner_op])
+
+    def test_forward_fallback(self):
+        expected, expected_winner = self._forward_with_winner(flex_pooling)
+        actual, winner = self._forward_with_winner(layers_fallback.flex_pooling)
+        self.assertAllClose(expected, actual)
+        self.assertAllEqual(expected_winner, winner)
+
     def test_backward(self):
         cpu, winner_cpu = self._backward(use_gpu=False)
         gpu, winner_gpu = self._backward(use_gpu=True)